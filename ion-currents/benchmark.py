@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the code in library.py
+#
+# Usage:
+#
+#   python benchmark.py                              Run all benchmarks
+#   python benchmark.py simulate load                Run selected benchmarks
+#   python benchmark.py --output results.json        Store the results
+#   python benchmark.py --baseline results.json      Compare to stored results
+#
+# Results are stored as JSON. When a baseline is given, the script exits with
+# status 1 if any benchmark is slower than the baseline by more than the
+# tolerance (25% by default).
+#
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+import myokit
+import pints
+
+# Make sure resources/ can be found, and library.py can be imported
+_root = os.path.dirname(os.path.abspath(__file__))
+os.chdir(_root)
+sys.path.insert(0, _root)
+
+import library  # noqa
+
+
+def benchmark_simulate(repeats):
+    """
+    Times a single simulation with each solver, on every step protocol in
+    ``resources/``, with the default parameters and a 0.1ms sampling rate.
+    """
+    model = myokit.load_model('resources/beattie-2017-ikr-hh.mmt')
+    parameters = [model.get('ikr.p' + str(1 + i)).eval() for i in range(9)]
+
+    results = {}
+    for path in _protocol_files():
+        name = os.path.splitext(os.path.basename(path))[0]
+        protocol = myokit.load_protocol(path)
+        times = np.arange(0, protocol.characteristic_time(), 0.1)
+        for solver in (library.ModelCVODESolver, library.ModelHHSolver):
+            m = solver(protocol)
+            m.simulate(parameters, times)  # Compile and warm up
+            results[solver.__name__ + '.simulate.' + name] = _time(
+                lambda: m.simulate(parameters, times), repeats)
+    return results
+
+
+def benchmark_boundaries(repeats, n=1000):
+    """
+    Times :meth:`Boundaries.check`, :meth:`Boundaries.check_many` and
+    :meth:`Boundaries.sample` on ``n`` points.
+    """
+    b = library.Boundaries()
+    points = b.sample(n)
+    return {
+        'Boundaries.check': _rate(
+            lambda: [b.check(p) for p in points], n, repeats, 'checks/s'),
+        'Boundaries.check_many': _rate(
+            lambda: b.check_many(points), n, repeats, 'checks/s'),
+        'Boundaries.sample': _rate(
+            lambda: b.sample(n), n, repeats, 'samples/s'),
+    }
+
+
+def benchmark_load(repeats):
+    """
+    Times :meth:`load` on the results in ``resources/four-ways``, once
+    parsing every file and once using the cache.
+
+    The results are copied to a temporary directory, so that no cache files
+    are created in ``resources``.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as d:
+        for method in sorted(os.listdir('resources/four-ways')):
+            source = os.path.join('resources', 'four-ways', method)
+            if not os.path.isdir(source):
+                continue
+            path = os.path.join(d, method)
+            shutil.copytree(source, path)
+            template = os.path.join(
+                path, 'cell-1-fit-' + method[-1] + '-run.txt')
+
+            with _quiet():
+                results['load.' + method] = _time(
+                    lambda: library.load(template, cache=False), repeats)
+                library.load(template)
+                results['load.' + method + '.cached'] = _time(
+                    lambda: library.load(template), repeats)
+    return results
+
+
+def benchmark_fit(repeats, max_iterations=100):
+    """
+    Measures the number of evaluations per second of short fits to synthetic
+    Pr3 data, using the analytical solver.
+    """
+    # Create synthetic data, with a fixed seed
+    np.random.seed(1)
+    protocol = myokit.load_protocol('resources/pr3-steady-activation.mmt')
+    times = np.arange(0, protocol.characteristic_time(), 0.1)
+    model = library.ModelHHSolver(protocol)
+    model_file = myokit.load_model('resources/beattie-2017-ikr-hh.mmt')
+    parameters = [
+        model_file.get('ikr.p' + str(1 + i)).eval() for i in range(9)]
+    values = model.simulate(parameters, times)
+    values += np.random.normal(0, 0.01 * np.max(np.abs(values)), times.shape)
+    problem = pints.SingleOutputProblem(model, times, values)
+    error = library.MeanSquaredError(problem)
+
+    rates = []
+    for i in range(repeats):
+        with tempfile.TemporaryDirectory() as d:
+            with _quiet():
+                library.fit(
+                    d, error, library.Boundaries(),
+                    library.transformation(), parallel=False,
+                    max_iterations=max_iterations)
+                parameters, info = library.load(os.path.join(d, 'result.txt'))
+            rates.append(info[0, 4] / info[0, 2])
+    return {'fit': _result(max(rates), 'evaluations/s')}
+
+
+# All benchmarks, by name
+benchmarks = {
+    'simulate': benchmark_simulate,
+    'boundaries': benchmark_boundaries,
+    'load': benchmark_load,
+    'fit': benchmark_fit,
+}
+
+
+def compare(results, baseline):
+    """
+    Compares ``results`` to a ``baseline`` and returns a list of tuples
+    ``(name, change)``, where ``change`` is the relative slowdown (e.g.
+    ``0.3`` for 30% slower). Only benchmarks present in both are compared.
+    """
+    changes = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None or old['unit'] != result['unit']:
+            continue
+        if result['unit'] == 's':
+            changes.append((name, result['value'] / old['value'] - 1))
+        else:
+            changes.append((name, old['value'] / result['value'] - 1))
+    return changes
+
+
+def run(names=None, repeats=5):
+    """
+    Runs the benchmarks with the given ``names`` (or all benchmarks), and
+    returns a dict with information about the system and a dict of results.
+    """
+    results = {}
+    for name in (names or benchmarks):
+        print('Running ' + name + ' benchmarks', file=sys.stderr)
+        results.update(benchmarks[name](repeats))
+
+    return {
+        'system': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'myokit': myokit.__version__,
+            'pints': pints.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+
+
+def _protocol_files():
+    """ Returns the paths to all protocol files in ``resources``. """
+    paths = []
+    for filename in sorted(os.listdir('resources')):
+        path = os.path.join('resources', filename)
+        if os.path.splitext(filename)[1] == '.mmt':
+            with open(path, 'r') as f:
+                if f.readline().strip() == '[[protocol]]':
+                    paths.append(path)
+    return paths
+
+
+@contextlib.contextmanager
+def _quiet():
+    """ Hides the output printed by library functions. """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def _rate(f, n, repeats, unit):
+    """ Returns the best rate at which ``f`` processes ``n`` items. """
+    return _result(n / _time(f, repeats)['value'], unit)
+
+
+def _result(value, unit):
+    """ Creates a result entry. """
+    return {'value': float(value), 'unit': unit}
+
+
+def _time(f, repeats, minimum=0.1):
+    """
+    Returns the fastest time (in seconds) of a call to ``f``.
+
+    Calls are grouped in batches lasting at least ``minimum`` seconds, and the
+    fastest average time in ``repeats`` batches is returned.
+    """
+    b = myokit.tools.Benchmarker()
+
+    # Find the number of calls per batch
+    n = 1
+    while True:
+        b.reset()
+        for i in range(n):
+            f()
+        t = b.time()
+        if t >= minimum:
+            break
+        n = max(n * 2, int(n * 1.2 * minimum / max(t, 1e-9)))
+
+    best = t / n
+    for i in range(repeats - 1):
+        b.reset()
+        for j in range(n):
+            f()
+        best = min(best, b.time() / n)
+    return _result(best, 's')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Runs benchmarks for the fitting library.')
+    parser.add_argument(
+        'names', nargs='*',
+        help='The benchmarks to run: ' + ', '.join(benchmarks)
+        + ' (default: all).')
+    parser.add_argument(
+        '--repeats', type=int, default=5,
+        help='The number of times each benchmark is repeated.')
+    parser.add_argument(
+        '--output', help='A path to store the results at, as JSON.')
+    parser.add_argument(
+        '--baseline', help='A JSON file with results to compare to.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='The maximum relative slowdown compared to the baseline.')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark: ' + name)
+
+    # Run benchmarks
+    output = run(args.names, args.repeats)
+    results = output['results']
+
+    # Store results
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    # Compare to baseline
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        changes = compare(results, baseline)
+        regressions = [x for x in changes if x[1] > args.tolerance]
+        for name, change in changes:
+            flag = '  REGRESSION' if change > args.tolerance else ''
+            print('{:<55} {:+7.1%}{}'.format(name, change, flag),
+                  file=sys.stderr)
+        if regressions:
+            print(str(len(regressions)) + ' regression(s) found.',
+                  file=sys.stderr)
+            sys.exit(1)
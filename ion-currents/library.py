@@ -4,15 +4,36 @@
 # Code library for use in the ion currents fitting notebooks.
 #
 #
+import collections
+import contextlib
+import copy
+import functools
 import glob
+import hashlib
+import json
+import multiprocessing
 import os
+import pickle
+import platform
+import queue
+import shutil
+import signal
+import sqlite3
+import sys
+import time
+import traceback
+
+try:
+    import fcntl
+except ImportError:     # pragma: no cover
+    fcntl = None
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 import pints
 import myokit
 import myokit.lib.hh
+import myokit.lib.markov
 
 
 class Boundaries(pints.Boundaries):
@@ -90,25 +111,61 @@ class Boundaries(pints.Boundaries):
         # All tests passed!
         return True
 
-    def _sample_partial(self, v):
-        """Samples a pair of kinetic parameters"""
+    def check_many(self, points):
+        """
+        Checks an array of ``n`` points at once, and returns a boolean array
+        of length ``n`` indicating which points are within the boundaries.
+        """
+        points = np.array(points, dtype=float, ndmin=2)
+
+        # Check parameter boundaries
+        ok = np.all(
+            (points > self._lower) & (points < self._upper), axis=1)
+
+        # Check rate boundaries
+        with np.errstate(over='ignore'):
+            kms = (
+                points[:, 0] * np.exp(points[:, 1] * self.v_high),
+                points[:, 2] * np.exp(-points[:, 3] * self.v_low),
+                points[:, 4] * np.exp(points[:, 5] * self.v_high),
+                points[:, 6] * np.exp(-points[:, 7] * self.v_low),
+            )
+        for km in kms:
+            ok &= (km > self.km_min) & (km < self.km_max)
+
+        return ok
+
+    def _sample_partial(self, v, n=1):
+        """
+        Samples ``n`` pairs of kinetic parameters, returns arrays ``(a, b)``.
+
+        Pairs are rejection sampled: rejected pairs are redrawn, until all
+        pairs are accepted or any pair has been rejected 100 times.
+        """
+        a = np.empty(n)
+        b = np.empty(n)
+        todo = np.arange(n)
         for i in range(100):
-            a = np.exp(np.random.uniform(
-                np.log(self.a_min), np.log(self.a_max)))
-            b = np.random.uniform(self.b_min, self.b_max)
-            km = a * np.exp(b * v)
-            if km > self.km_min and km < self.km_max:
+            m = len(todo)
+            a_new = np.exp(np.random.uniform(
+                np.log(self.a_min), np.log(self.a_max), m))
+            b_new = np.random.uniform(self.b_min, self.b_max, m)
+            km = a_new * np.exp(b_new * v)
+            ok = (km > self.km_min) & (km < self.km_max)
+            a[todo[ok]] = a_new[ok]
+            b[todo[ok]] = b_new[ok]
+            todo = todo[~ok]
+            if len(todo) == 0:
                 return a, b
         raise ValueError('Too many iterations')
 
     def sample(self, n=1):
         points = np.zeros((n, 9))
-        for i in range(n):
-            points[i, 0:2] = self._sample_partial(self.v_high)
-            points[i, 2:4] = self._sample_partial(-self.v_low)
-            points[i, 4:6] = self._sample_partial(self.v_high)
-            points[i, 6:8] = self._sample_partial(-self.v_low)
-            points[i, 8] = np.random.uniform(self.g_min, self.g_max)
+        points[:, 0], points[:, 1] = self._sample_partial(self.v_high, n)
+        points[:, 2], points[:, 3] = self._sample_partial(-self.v_low, n)
+        points[:, 4], points[:, 5] = self._sample_partial(self.v_high, n)
+        points[:, 6], points[:, 7] = self._sample_partial(-self.v_low, n)
+        points[:, 8] = np.random.uniform(self.g_min, self.g_max, n)
         return points
 
 
@@ -147,6 +204,7 @@ def univariate_boundary_plot(a_log=False, b_log=False):
     b = Boundaries()
 
     # Create a figure
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(16, 2.6))
     fig.subplots_adjust(wspace=0.4)
 
@@ -229,6 +287,7 @@ def multivariate_boundary_plot(a_log=False):
     p4_min = np.maximum(p4_min, b.b_min)
 
     # Create a figure
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(16, 2.6))
     fig.subplots_adjust(wspace=0.4)
 
@@ -300,76 +359,1996 @@ def boundary_plot_point(axes, x, *args, **kwargs):
     axes[4].plot(x[:, 8], 0 * x[:, 8], *args, **kwargs)
 
 
-class ModelCVODESolver(pints.ForwardModel):
-    """A forward model that runs simulations with CVODE."""
+def load_log(path, cache=True):
+    """
+    Loads a :class:`myokit.DataLog` stored at ``path`` (e.g. a zip file of
+    recorded data), returning a log in which each variable is a read-only,
+    memory-mapped numpy array.
+
+    The first time a log is loaded, it is converted to a set of uncompressed
+    ``.npy`` files (one per variable) in a hidden directory next to the log,
+    e.g. ``resources/.cell-1.zip.npy``. Subsequent calls map these files into
+    memory instead of decompressing the log, so that multiple processes (such
+    as the workers in a :class:`WorkerPool`) can share the same data without
+    copying it. The cache is recreated if the log's modification time or size
+    changes.
+
+    Parameters
+    ----------
+    path
+        The path to a log file that can be read with
+        :meth:`myokit.DataLog.load`.
+    cache
+        Set to ``False`` to load the log without creating or using a cache.
+        The variables are still returned as (read-only) numpy arrays.
+    """
+    if not cache:
+        log = myokit.DataLog.load(path).npview()
+        for array in log.values():
+            array.setflags(write=False)
+        return log
+
+    # Find cache, and check if it is up to date
+    dirname, filename = os.path.split(path)
+    cache_dir = os.path.join(dirname, '.' + filename + '.npy')
+    stat = os.stat(path)
+    stamp = str(stat.st_mtime_ns) + ' ' + str(stat.st_size)
+
+    def read_index():
+        """ Returns the cache's index if it is up to date, else ``None``. """
+        try:
+            with open(os.path.join(cache_dir, 'index.txt'), 'r') as f:
+                index = f.read().splitlines()
+            if index[0] == stamp:
+                return index
+        except (OSError, IndexError):
+            pass
+        return None
+
+    index = read_index()
+
+    # Convert, writing into a temporary directory that is then moved into
+    # place, so that other processes never see a partial cache
+    if index is None:
+        log = myokit.DataLog.load(path)
+        keys = list(log.keys())
+        time_key = log.time_key()
+        if time_key in keys:
+            keys.remove(time_key)
+            keys.insert(0, time_key)
+        index = [stamp, time_key or ''] + keys
+
+        temp_dir = cache_dir + '.' + str(os.getpid()) + '.tmp'
+        os.makedirs(temp_dir, exist_ok=True)
+        for i, key in enumerate(keys):
+            np.save(os.path.join(temp_dir, str(i) + '.npy'),
+                    np.asarray(log[key], dtype=float))
+        with open(os.path.join(temp_dir, 'index.txt'), 'w') as f:
+            f.write('\n'.join(index) + '\n')
+        del log
+
+        if read_index() is not None:
+            # Another process created an up to date cache in the meantime,
+            # and may already be reading from it
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        else:
+            # Replace any stale cache
+            if os.path.isdir(cache_dir):
+                old_dir = temp_dir + '.old'
+                try:
+                    os.replace(cache_dir, old_dir)
+                    shutil.rmtree(old_dir)
+                except OSError:
+                    pass
+            try:
+                os.replace(temp_dir, cache_dir)
+            except OSError:
+                # Another process created the cache first
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    # Map the cached arrays into memory
+    log = myokit.DataLog()
+    for i, key in enumerate(index[2:]):
+        log[key] = np.load(
+            os.path.join(cache_dir, str(i) + '.npy'), mmap_mode='r')
+    if index[1]:
+        log.set_time_key(index[1])
+    return log
+
+
+class CompiledProtocol(object):
+    """
+    A flat, immutable representation of a step protocol, compiled for a fixed
+    sequence of log times.
+
+    The protocol is converted to arrays containing the start time, duration,
+    and voltage of every step (including any periods where no event is active
+    and the voltage is zero). For each step, the indices of the first and last
+    (plus one) log time inside the step are stored, along with the time since
+    the start of the step for every log time. Simulations can then find their
+    log times by slicing, instead of searching through the protocol and times
+    on every call.
+
+    Parameters
+    ----------
+    protocol
+        A :class:`myokit.Protocol`.
+    times
+        The non-decreasing sequence of times that simulations will be logged
+        at. Steps are created up to time ``times[-1] + (times[-1] -
+        times[-2])``.
+    """
+    def __init__(self, protocol, times):
+
+        # Store protocol and times
+        self._protocol = protocol.clone()
+        self._times = np.array(times, dtype=float)
+        self._tmax = self._times[-1] + (self._times[-1] - self._times[-2])
+
+        # Walk through the protocol, and store steps
+        pacing = myokit.PacingSystem(protocol)
+        start, end, voltage = [], [], []
+        t = 0
+        v = pacing.advance(t)
+        while t < self._tmax:
+            tnext = min(self._tmax, pacing.next_time())
+            start.append(t)
+            end.append(tnext)
+            voltage.append(v)
+            v = pacing.advance(tnext)
+            t = tnext
+        self._start = np.array(start)
+        self._duration = np.array(end) - self._start
+        self._voltage = np.array(voltage, dtype=float)
+        self._levels, self._level_index = np.unique(
+            self._voltage, return_inverse=True)
+
+        # Find the log times within each step
+        self._lo = np.searchsorted(self._times, self._start)
+        self._hi = np.searchsorted(self._times, end)
+        self._offsets = np.empty(self._times.shape)
+        self._offsets[self._lo[0]:self._hi[-1]] = self._times[
+            self._lo[0]:self._hi[-1]] - np.repeat(
+                self._start, self._hi - self._lo)
+
+        # Make immutable
+        for x in (self._times, self._start, self._duration, self._voltage,
+                  self._levels, self._level_index, self._lo, self._hi,
+                  self._offsets):
+            x.setflags(write=False)
+
+    def __len__(self):
+        return len(self._start)
+
+    def duration(self):
+        """ Returns an array with the duration of each step. """
+        return self._duration
+
+    def levels(self):
+        """
+        Returns a tuple ``(levels, index)`` where ``levels`` is an ordered
+        array of the unique voltages used in this protocol, and ``index`` is an
+        array such that ``levels[index[i]]`` is the voltage during step ``i``.
+        """
+        return self._levels, self._level_index
+
+    def matches(self, times):
+        """
+        Returns ``True`` if this protocol was compiled for the given ``times``.
+        """
+        return np.array_equal(self._times, times)
+
+    def offsets(self):
+        """
+        Returns an array containing, for each log time, the time elapsed since
+        the start of the step it falls in.
+        """
+        return self._offsets
+
+    def protocol(self):
+        """ Returns a copy of the original :class:`myokit.Protocol`. """
+        return self._protocol.clone()
+
+    def ranges(self):
+        """
+        Returns a tuple ``(lo, hi)`` such that ``times[lo[i]:hi[i]]`` are the
+        log times inside step ``i``.
+        """
+        return self._lo, self._hi
+
+    def start(self):
+        """ Returns an array with the start time of each step. """
+        return self._start
+
+    def times(self):
+        """ Returns the log times this protocol was compiled for. """
+        return self._times
+
+    def tmax(self):
+        """ Returns the time at which the final step ends. """
+        return self._tmax
+
+    def voltage(self):
+        """ Returns an array with the voltage during each step. """
+        return self._voltage
+
+
+class Profiler(object):
+    """
+    Collects the time spent in different parts of a fit, and counts events
+    such as failed simulations.
+
+    A profiler is activated by using it as a context manager::
+
+        profiler = Profiler()
+        with profiler:
+            error(x)
+        profiler.save('profile.json')
+
+    While a profiler is active, the simulation, error, and transformation
+    methods in this module, and each step of the optimisation loop in
+    :meth:`fit`, add their run time to it. Timers can be nested, so that the
+    time for e.g. ``simulate.hh`` is also included in ``error``. When no
+    profiler is active, the only overhead is a single check per call.
+    """
+    def __init__(self):
+        self._times = collections.defaultdict(float)
+        self._calls = collections.defaultdict(int)
+        self._counts = collections.defaultdict(int)
+        self._previous = []
+
+    def __enter__(self):
+        global _profiler
+        self._previous.append(_profiler)
+        _profiler = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _profiler
+        _profiler = self._previous.pop()
+
+    def add_time(self, name, seconds, calls=1):
+        """ Adds ``seconds`` spent in ``calls`` calls to the timer ``name``.
+        """
+        self._times[name] += seconds
+        self._calls[name] += calls
+
+    def count(self, name, n=1):
+        """ Increases the counter ``name`` by ``n``. """
+        self._counts[name] += int(n)
+
+    def counts(self):
+        """ Returns a dict mapping counter names to counts. """
+        return dict(self._counts)
+
+    def merge(self, profile):
+        """
+        Adds the timers and counts in a ``profile`` dict (as returned by
+        :meth:`to_dict`) to this profiler.
+        """
+        for name, timer in profile['timers'].items():
+            self.add_time(name, timer['time'], timer['calls'])
+        for name, n in profile['counts'].items():
+            self.count(name, n)
+
+    def save(self, path):
+        """ Stores this profile at ``path``, in JSON format. """
+        print('Writing profile to ' + str(path))
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+    def times(self):
+        """ Returns a dict mapping timer names to tuples ``(time, calls)``.
+        """
+        return {k: (v, self._calls[k]) for k, v in self._times.items()}
+
+    def to_dict(self):
+        """
+        Returns a dict ``{'timers': {name: {'time': t, 'calls': n}}, 'counts':
+        {name: n}}``.
+        """
+        return {
+            'timers': {
+                k: {'time': self._times[k], 'calls': self._calls[k]}
+                for k in sorted(self._times)},
+            'counts': {k: self._counts[k] for k in sorted(self._counts)},
+        }
+
+
+# The active profiler, if any
+_profiler = None
+
+
+def _profiled(name):
+    """
+    Decorator that adds the time spent in a method to the timer ``name`` of
+    the active :class:`Profiler`, if there is one.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return method(*args, **kwargs)
+            profiler = _profiler
+            t = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                profiler.add_time(name, time.perf_counter() - t)
+        return wrapper
+    return decorator
+
+
+# Directory containing the model and protocol files
+_resources = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'resources')
+
+# Directory to store compiled simulations in
+_simulation_dir = os.path.join(
+    os.path.expanduser('~'), '.cache', 'fitting-notebooks')
+
+# Objects created from files, as a dict mapping (kind, path) to (mtime, object)
+_file_cache = {}
+
+
+def _cached(kind, path, create):
+    """
+    Returns ``create(path)``, cached per process using the ``kind`` of object,
+    the absolute ``path``, and the file's modification time.
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    entry = _file_cache.get((kind, path))
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+    value = create(path)
+    _file_cache[kind, path] = (mtime, value)
+    return value
+
+
+def load_model(path):
+    """
+    Loads a :class:`myokit.Model` from ``path``.
+
+    Parsed models are cached per process, and re-read only if the file has
+    changed. Each call returns a new copy, which can be modified freely.
+    """
+    return _cached('model', path, myokit.load_model).clone()
+
+
+def load_protocol(path):
+    """
+    Loads a :class:`myokit.Protocol` from ``path``.
+
+    Parsed protocols are cached per process, and re-read only if the file has
+    changed. Each call returns a new copy, which can be modified freely.
+    """
+    return _cached('protocol', path, myokit.load_protocol).clone()
 
-    def __init__(self, protocol):
 
-        # Load a model, and isolate the HH ion current model part
-        model = myokit.load_model('resources/beattie-2017-ikr-hh.mmt')
+def _ion_current(filename, kind):
+    """
+    Returns a tuple ``(model, current, y0, ek)`` for the model file
+    ``filename`` in ``resources``, where ``current`` is a
+    :class:`myokit.lib.hh.HHModel` (if ``kind='hh'``) or a
+    :class:`myokit.lib.markov.LinearModel` (if ``kind='markov'``) for the
+    ``ikr`` component with parameters ``p1`` to ``p9``, ``y0`` is a dict with
+    its -80mV steady state, and ``ek`` is the reversal potential.
+
+    The returned objects are shared within a process and must not be
+    modified.
+    """
+    def create(path):
+        model = _cached('model', path, myokit.load_model)
         parameters = ['ikr.p' + str(1 + i) for i in range(9)]
-        hh_model = myokit.lib.hh.HHModel.from_component(
-            model.get('ikr'), parameters=parameters)
+        if kind == 'hh':
+            current = myokit.lib.hh.HHModel.from_component(
+                model.get('ikr'), parameters=parameters)
+        else:
+            current = myokit.lib.markov.LinearModel.from_component(
+                model.get('ikr'), parameters=parameters)
+        y0 = {
+            x: float(v)
+            for x, v in zip(current.states(), current.steady_state(-80))}
+        ek = model.get('nernst.EK').eval()
+        return model, current, y0, ek
+
+    return _cached(kind, os.path.join(_resources, filename), create)
+
+
+def _simulation(filename, protocol):
+    """
+    Creates a :class:`myokit.Simulation` for the model file ``filename`` in
+    ``resources``, running the given ``protocol``.
+
+    Compiled simulations are stored in ``~/.cache/fitting-notebooks``, using a
+    hash of the model code and the Myokit, Python, and platform versions, so
+    that they can be reused by other processes. Within a process, the
+    compiled module is loaded only once, and shared by all simulations.
+
+    This relies on the ``path`` argument to :class:`myokit.Simulation`, which
+    is only partly public. If storing, loading, or reusing a compiled
+    simulation fails, a new simulation is compiled in the usual way instead.
+    """
+    path = os.path.join(_resources, filename)
+    model = _cached('model', path, myokit.load_model)
+    cached = _cached('simulation', path, _compile_simulation)
+    if cached is not None:
+        try:
+            return myokit.Simulation(model, protocol, None, cached)
+        except Exception as e:
+            print('Unable to reuse compiled simulation: ' + str(e))
+    return myokit.Simulation(model, protocol)
+
+
+def _compile_simulation(path):
+    """
+    Loads or compiles the simulation for the model at ``path``, and returns a
+    tuple ``(build, module)`` with the path to the stored build and the
+    compiled module, or ``None`` if this fails.
+    """
+    try:
+        return _load_or_compile_simulation(path)
+    except Exception as e:
+        print('Unable to store compiled simulation: ' + str(e))
+        return None
+
+
+def _load_or_compile_simulation(path):
+    """ See :meth:`_compile_simulation`. """
+    model = _cached('model', path, myokit.load_model)
+    key = '\n'.join(
+        (model.code(), myokit.__version__, sys.version, platform.platform()))
+    key = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    build = os.path.join(_simulation_dir, name + '-' + key + '.zip')
+
+    # Load a stored build, if possible
+    if os.path.isfile(build):
+        try:
+            return build, myokit.Simulation.from_path(build)._sim
+        except Exception as e:
+            print('Unable to load compiled simulation from ' + build + ': '
+                  + str(e))
+
+    # Compile, and store atomically so that concurrent processes never see a
+    # partial file
+    os.makedirs(_simulation_dir, exist_ok=True)
+    temp = build + '.' + str(os.getpid()) + '.tmp'
+    try:
+        sim = myokit.Simulation(model, path=temp)
+        os.replace(temp, build)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return build, sim._sim
+
+
+class ModelCVODESolver(pints.ForwardModel):
+    """
+    A forward model that runs simulations with CVODE.
+
+    The ``protocol`` can be given as a :class:`myokit.Protocol` or a
+    :class:`CompiledProtocol`. The latter is accepted so that the same
+    arguments can be passed to every model in this module, but CVODE gains
+    nothing from it: only the underlying :class:`myokit.Protocol` is used.
+
+    Solver tolerances can be set as a tuple ``(abs_tol, rel_tol)`` with
+    ``tolerance`` (the default is Myokit's ``(1e-6, 1e-4)``). If a
+    ``loose_tolerance`` is also given, :meth:`set_loose` can be used to switch
+    between the two. This is done automatically when the model is used in a
+    :class:`MultiResolutionError`, so that an optimisation explores with loose
+    tolerances and finishes with tight ones.
+
+    Failed simulations return an array of NaNs. Instead of printing a message
+    for each failure, the number of failures is counted and the last failing
+    parameters are stored, see :meth:`n_failures` and :meth:`last_failure`.
+    """
+
+    def __init__(self, protocol, tolerance=None, loose_tolerance=None):
+
+        # Get the (cached) model, and the HH ion current model part
+        model, hh_model, y0, _ = _ion_current(
+            'beattie-2017-ikr-hh.mmt', 'hh')
+        parameters = hh_model.parameters()
 
-        # Create a CVODE Simulation
-        self.sim = myokit.Simulation(model, protocol)
+        # Create a CVODE Simulation, reusing a compiled module if possible
+        if isinstance(protocol, CompiledProtocol):
+            protocol = protocol.protocol()
+        self.sim = _simulation('beattie-2017-ikr-hh.mmt', protocol)
 
         # Set the -80mV steady state as the default state
-        self.sim.set_default_state(hh_model.steady_state(-80))
+        self.sim.set_default_state(y0)
+
+        # Store parameter names and current values, so that only changed
+        # values need to be passed to the simulation
+        self._parameters = parameters
+        self._values = [model.get(p).eval() for p in parameters]
+
+        # Set tolerances
+        self._tolerance = None
+        if tolerance is not None:
+            self._tolerance = tuple(float(x) for x in tolerance)
+            if len(self._tolerance) != 2:
+                raise ValueError('Tolerance must be a tuple (abs, rel).')
+            self.sim.set_tolerance(*self._tolerance)
+        self._loose_tolerance = None
+        if loose_tolerance is not None:
+            self._loose_tolerance = tuple(float(x) for x in loose_tolerance)
+            if len(self._loose_tolerance) != 2:
+                raise ValueError('Loose tolerance must be a tuple (abs, rel).')
+
+        # Tolerance selection and failure statistics, in a dict that is shared
+        # with any copies of this model (see __copy__)
+        self._state = {
+            'loose': False,
+            'simulations': 0,
+            'failures': 0,
+            'last_failure': None,
+        }
+
+    def __copy__(self):
+        """
+        Returns a copy of this model that can be used with different log times
+        (e.g. in a :class:`MultiResolutionError`).
+
+        The copy shares this model's simulation, so it also shares its
+        parameter values, tolerance selection, and failure statistics.
+        """
+        other = ModelCVODESolver.__new__(ModelCVODESolver)
+        other.__dict__.update(self.__dict__)
+        return other
+
+    def last_failure(self):
+        """
+        Returns the parameters of the last failed simulation, or ``None``.
+        """
+        return self._state['last_failure']
+
+    def loose(self):
+        """ Returns ``True`` if the loose tolerances are currently used. """
+        return self._state['loose']
+
+    def n_failures(self):
+        """ Returns the number of failed simulations. """
+        return self._state['failures']
 
     def n_parameters(self):
         return 9
 
+    def n_simulations(self):
+        """ Returns the number of simulations run. """
+        return self._state['simulations']
+
+    def set_loose(self, loose):
+        """
+        Selects the loose (``True``) or normal (``False``) tolerances. This has
+        no effect if no ``loose_tolerance`` was set.
+        """
+        if self._loose_tolerance is None:
+            return
+        self._state['loose'] = bool(loose)
+        if self._state['loose']:
+            self.sim.set_tolerance(*self._loose_tolerance)
+        elif self._tolerance is None:
+            self.sim.set_tolerance()
+        else:
+            self.sim.set_tolerance(*self._tolerance)
+
+    @_profiled('simulate.cvode')
     def simulate(self, parameters, times):
 
         # Reset to default time and state
         self.sim.reset()
 
-        # Apply parameters
+        # Apply any changed parameters
         for i, p in enumerate(parameters):
-            self.sim.set_constant('ikr.p' + str(1 + i), p)
+            if p != self._values[i]:
+                self.sim.set_constant(self._parameters[i], p)
+                self._values[i] = p
 
         # Run
         tmax = times[-1] + (times[-1] - times[-2])
+        self._state['simulations'] += 1
         try:
             log = self.sim.run(tmax, log_times=times, log=['ikr.IKr'])
             return log['ikr.IKr']
         except myokit.SimulationError:
-            print('Error evaluating with parameters: ' + str(parameters))
+            self._state['failures'] += 1
+            self._state['last_failure'] = np.array(parameters, copy=True)
+            if _profiler is not None:
+                _profiler.count('simulate.failed')
             return np.nan * times
 
 
+# Single precision copies of arrays, as an ordered dict mapping id(array) to a
+# tuple (array, copy)
+_single_cache = collections.OrderedDict()
+
+
+def _single(x):
+    """
+    Returns a ``float32`` copy of the array ``x``, cached for the last few
+    arrays (e.g. the log time offsets and data used in every evaluation).
+
+    Arrays passed in must not be modified afterwards.
+    """
+    key = id(x)
+    entry = _single_cache.get(key)
+    if entry is not None and entry[0] is x:
+        _single_cache.move_to_end(key)
+        return entry[1]
+    _single_cache[key] = (x, np.asarray(x, dtype=np.float32))
+    if len(_single_cache) > 16:
+        _single_cache.popitem(last=False)
+    return _single_cache[key][1]
+
+
 class ModelHHSolver(pints.ForwardModel):
     """
     A forward model that runs simulations on step protocols, using an
     analytical solving method for Hodgkin-Huxley models.
+
+    The ``protocol`` can be given as a :class:`myokit.Protocol` or a
+    :class:`CompiledProtocol`. In the first case, the protocol is compiled the
+    first time :meth:`simulate` is called, and again whenever the log times
+    change.
+
+    Steady states and rates are calculated once per simulation for each
+    voltage used in the protocol, for all parameter vectors at once.
+
+    If ``single_precision`` is set to ``True``, :meth:`set_loose` can be used
+    to switch to calculations in ``float32``, which roughly halves the memory
+    traffic per simulation. As with the loose tolerances of a
+    :class:`ModelCVODESolver`, this is done automatically when the model is
+    used in a :class:`MultiResolutionError`, so that an optimisation explores
+    in single precision and finishes in double precision.
     """
 
-    def __init__(self, protocol):
+    def __init__(self, protocol, single_precision=False):
 
-        # Load a model, and isolate the HH ion current model part
-        model = myokit.load_model('resources/beattie-2017-ikr-hh.mmt')
-        parameters = ['ikr.p' + str(1 + i) for i in range(9)]
-        hh_model = myokit.lib.hh.HHModel.from_component(
-            model.get('ikr'), parameters=parameters)
+        # Get the (cached) HH model's steady state and reversal potential
+        _, _, y0, ek = _ion_current('beattie-2017-ikr-hh.mmt', 'hh')
 
-        # Create an analytical simulation
-        self.sim = myokit.lib.hh.AnalyticalSimulation(hh_model, protocol)
+        # Store protocol
+        self._compiled = None
+        if isinstance(protocol, CompiledProtocol):
+            self._compiled = protocol
+            protocol = protocol.protocol()
+        self._protocol = protocol.clone()
 
-        # Set the -80mV steady state as the default state
-        self.sim.set_default_state(hh_model.steady_state(-80))
+        # Use the -80mV steady state as the initial state
+        self._a0 = y0['ikr.act']
+        self._r0 = y0['ikr.rec']
+
+        # Store reversal potential
+        self._ek = ek
+
+        # Precision
+        self._single_precision = bool(single_precision)
+        self._loose = False
+
+    def loose(self):
+        """ Returns ``True`` if single precision is currently used. """
+        return self._loose
 
     def n_parameters(self):
         return 9
 
+    def set_loose(self, loose):
+        """
+        Selects single (``True``) or double (``False``) precision. This has no
+        effect if ``single_precision`` was not set.
+        """
+        if self._single_precision:
+            self._loose = bool(loose)
+
     def simulate(self, parameters, times):
+        return self.simulate_batch([parameters], times)[0]
+
+    def simulate_batch(self, parameters, times):
+        """
+        Runs simulations for ``n`` parameter vectors at once, and returns an
+        array of shape ``(n, len(times))``.
+
+        This evaluates the closed-form solution of the HH equations for all
+        parameter vectors at once, one protocol step at a time.
+
+        Parameters
+        ----------
+        parameters
+            An array of shape ``(n, 9)``.
+        times
+            A non-decreasing sequence of times to evaluate at.
+        """
+        p = np.array(parameters, dtype=float, ndmin=2)
+
+        # Compile protocol, if needed
+        if self._compiled is None or not self._compiled.matches(times):
+            self._compiled = CompiledProtocol(self._protocol, times)
+
+        return self._sweep(p, self._compiled)
+
+    def sum_of_squares_batch(self, parameters, times, values):
+        """
+        Returns the sum of squared differences between the simulated current
+        and ``values`` for ``n`` parameter vectors at once, as an array of
+        length ``n``.
+
+        The residuals are calculated and reduced one protocol step at a time,
+        so that no full current traces are stored.
+
+        Parameters
+        ----------
+        parameters
+            An array of shape ``(n, 9)``.
+        times
+            A non-decreasing sequence of times to evaluate at.
+        values
+            The data to compare to, with one value per time.
+        """
+        p = np.array(parameters, dtype=float, ndmin=2)
+        values = np.asarray(values, dtype=float)
+        if values.shape != np.shape(times):
+            raise ValueError('Times and values must have the same shapes.')
+
+        # Compile protocol, if needed
+        if self._compiled is None or not self._compiled.matches(times):
+            self._compiled = CompiledProtocol(self._protocol, times)
+
+        return np.sum(self._sweep(p, self._compiled, data=values), axis=1)
+
+    @staticmethod
+    def _rates(p, voltages):
+        """
+        Returns an array of shape ``(4, n, m)`` containing the steady states
+        and rates ``(a_inf, a_rate, r_inf, r_rate)`` for ``n`` parameter
+        vectors ``p`` at ``m`` ``voltages``.
+        """
+        v = np.asarray(voltages, dtype=float)[None, :]
+        k1 = p[:, 0:1] * np.exp(p[:, 1:2] * v)
+        k2 = p[:, 2:3] * np.exp(-p[:, 3:4] * v)
+        k3 = p[:, 4:5] * np.exp(p[:, 5:6] * v)
+        k4 = p[:, 6:7] * np.exp(-p[:, 7:8] * v)
+        a_rate = k1 + k2
+        r_rate = k3 + k4
+        return np.array([k1 / a_rate, a_rate, k4 / r_rate, r_rate])
+
+    @_profiled('simulate.hh')
+    def _sweep(self, p, compiled, resets=(), data=None):
+        """
+        Evaluates the solution for parameters ``p`` (with shape ``(n, 9)``) on
+        a compiled protocol, and returns an array of shape ``(n,
+        len(compiled.times()))``.
+
+        At the start of every step whose index is in ``resets`` the states are
+        set back to their initial values, so that several concatenated
+        protocols can be run in a single sweep.
+
+        If ``data`` (with one value per log time) is given, the current is
+        not stored. Instead, the sum of squared differences between current
+        and data is calculated for each step, and an array of shape ``(n,
+        len(compiled))`` is returned.
+
+        In single precision mode (see :meth:`set_loose`) all arrays except
+        the returned sums of squares are ``float32``.
+        """
+        lo, hi = compiled.ranges()
+        offsets = compiled.offsets()
+        duration = compiled.duration()
+        dtype = np.float32 if self._loose else float
+        if self._loose:
+            offsets, duration = _single(offsets), _single(duration)
+            if data is not None:
+                data = _single(data)
+
+        # Get steady states and (inverse) time constants at every voltage,
+        # and the driving term for every step
+        levels, index = compiled.levels()
+        rates = self._rates(p, levels).astype(dtype, copy=False)
+        drive = p[:, 8:9] * (compiled.voltage() - self._ek)
+        drive = drive.astype(dtype, copy=False)
+
+        # Initial states, for each parameter vector
+        n = len(p)
+        a = np.full(n, self._a0, dtype=dtype)
+        r = np.full(n, self._r0, dtype=dtype)
+        resets = set(resets)
+
+        # Evaluate the solution step by step, using work arrays to avoid
+        # allocating temporary arrays for every step
+        if data is None:
+            current = np.empty((n, len(compiled.times())), dtype=dtype)
+        else:
+            current = np.zeros((n, len(compiled)))
+        m = np.max(hi - lo) if len(lo) else 0
+        ax = np.empty((n, m), dtype=dtype)
+        rx = np.empty((n, m), dtype=dtype)
+        for i in range(len(compiled)):
+            a_inf, a_rate, r_inf, r_rate = rates[:, :, index[i]]
+            if i in resets:
+                a = np.full(n, self._a0, dtype=dtype)
+                r = np.full(n, self._r0, dtype=dtype)
+
+            # Evaluate current at the logged times within this step
+            if hi[i] > lo[i]:
+                dt = offsets[lo[i]:hi[i]]
+                x = ax[:, :len(dt)]
+                np.multiply(-a_rate[:, None], dt, out=x)
+                np.exp(x, out=x)
+                x *= (a - a_inf)[:, None]
+                x += a_inf[:, None]
+                y = rx[:, :len(dt)]
+                np.multiply(-r_rate[:, None], dt, out=y)
+                np.exp(y, out=y)
+                y *= (r - r_inf)[:, None]
+                y += r_inf[:, None]
+                y *= drive[:, i:i + 1]
+                if data is None:
+                    np.multiply(x, y, out=current[:, lo[i]:hi[i]])
+                else:
+                    x *= y
+                    x -= data[lo[i]:hi[i]]
+                    current[:, i] = np.einsum('nt,nt->n', x, x)
+
+            # Update states to the end of the step
+            dt = duration[i]
+            a = a_inf + (a - a_inf) * np.exp(-a_rate * dt)
+            r = r_inf + (r - r_inf) * np.exp(-r_rate * dt)
+
+        # Count simulations with non-finite results
+        if _profiler is not None:
+            _profiler.count(
+                'simulate.failed', n - np.count_nonzero(
+                    np.all(np.isfinite(current), axis=1)))
+
+        return current
+
+    def simulateS1(self, parameters, times):
+        """
+        Runs a simulation and returns a tuple ``(current, dcurrent)``, where
+        ``dcurrent`` is an array of shape ``(len(times), 9)`` containing the
+        partial derivatives of the current with respect to each parameter.
+
+        The derivatives are obtained by differentiating the closed-form
+        solution for each step, and are propagated from step to step along
+        with the states. Because the initial state is calculated with the
+        model's default parameters, its derivatives are zero.
+        """
+        p = np.array(parameters, dtype=float)
+
+        # Compile protocol, if needed
+        if self._compiled is None or not self._compiled.matches(times):
+            self._compiled = CompiledProtocol(self._protocol, times)
+        lo, hi = self._compiled.ranges()
+        offsets = self._compiled.offsets()
+        levels, index = self._compiled.levels()
+
+        # Calculate transition rates, and their derivatives with respect to
+        # (p1, p2, p3, p4) for k1 and k2, and (p5, p6, p7, p8) for k3 and k4
+        v = levels
+        e1, e2 = np.exp(p[1] * v), np.exp(-p[3] * v)
+        e3, e4 = np.exp(p[5] * v), np.exp(-p[7] * v)
+        k1, k2, k3, k4 = p[0] * e1, p[2] * e2, p[4] * e3, p[6] * e4
+        zero = np.zeros(len(v))
+        dk1 = np.stack((e1, v * k1, zero, zero), axis=1)
+        dk2 = np.stack((zero, zero, e2, -v * k2), axis=1)
+        dk3 = np.stack((e3, v * k3, zero, zero), axis=1)
+        dk4 = np.stack((zero, zero, e4, -v * k4), axis=1)
+
+        # Get steady states and rates, and their derivatives
+        a_inf, a_rate, da_inf, da_rate = self._gate_s1(k1, k2, dk1, dk2)
+        r_inf, r_rate, dr_inf, dr_rate = self._gate_s1(k4, k3, dk4, dk3)
+
+        # Initial states and their derivatives
+        a, r = self._a0, self._r0
+        da, dr = np.zeros(4), np.zeros(4)
+
+        # Evaluate the solution step by step
+        current = np.empty(len(times))
+        dcurrent = np.empty((len(times), 9))
+        for i, v in enumerate(self._compiled.voltage()):
+            j = index[i]
+            g = v - self._ek
+
+            # Evaluate current at the logged times within this step
+            if hi[i] > lo[i]:
+                dt = offsets[lo[i]:hi[i]]
+                ax, dax = self._step_s1(
+                    a, da, a_inf[j], a_rate[j], da_inf[j], da_rate[j], dt)
+                rx, drx = self._step_s1(
+                    r, dr, r_inf[j], r_rate[j], dr_inf[j], dr_rate[j], dt)
+                current[lo[i]:hi[i]] = p[8] * g * ax * rx
+                dcurrent[lo[i]:hi[i], :4] = p[8] * g * dax * rx[:, None]
+                dcurrent[lo[i]:hi[i], 4:8] = p[8] * g * ax[:, None] * drx
+                dcurrent[lo[i]:hi[i], 8] = g * ax * rx
+
+            # Update states to the end of the step
+            dt = self._compiled.duration()[i]
+            a, da = self._step_s1(
+                a, da, a_inf[j], a_rate[j], da_inf[j], da_rate[j], dt)
+            r, dr = self._step_s1(
+                r, dr, r_inf[j], r_rate[j], dr_inf[j], dr_rate[j], dt)
+
+        return current, dcurrent
+
+    @staticmethod
+    def _gate_s1(kx, ky, dkx, dky):
+        """
+        Returns the steady state ``kx / (kx + ky)`` and rate ``kx + ky`` of a
+        gate, along with their derivatives.
+        """
+        rate = kx + ky
+        inf = kx / rate
+        dinf = (dkx * ky[:, None] - kx[:, None] * dky) / (rate**2)[:, None]
+        return inf, rate, dinf, dkx + dky
+
+    @staticmethod
+    def _step_s1(x, dx, inf, rate, dinf, drate, dt):
+        """
+        Evaluates a gate ``x`` with derivatives ``dx`` after a time (or array
+        of times) ``dt``, and returns the new state(s) and derivatives.
+        """
+        e = np.exp(-rate * dt)
+        y = inf + (x - inf) * e
+        c = ((x - inf) * dt)[..., None]
+        e = e[..., None]
+        return y, (1 - e) * dinf + e * (dx - c * drate)
+
+
+class ModelMarkovSolver(pints.ForwardModel):
+    """
+    A forward model that runs simulations on step protocols with the Markov
+    model form of the model by Beattie et al., using the eigendecomposition
+    of its transition matrix.
+
+    For every parameter vector and every voltage used in the protocol, the
+    transition matrix ``A`` is decomposed as ``A = V diag(l) V^-1``, after
+    which the state at any time within a step follows from
+    ``x(t) = V diag(exp(l t)) V^-1 x(0)``. All decompositions for a batch of
+    parameter vectors are calculated with a single call to
+    ``numpy.linalg.eig``, and the states are then propagated through all
+    protocol steps in a single pass. Parameter vectors for which the
+    decomposition fails (e.g. because they contain non-finite values) give
+    NaN results, without affecting the other vectors in the batch.
+
+    For parameters sampled from :class:`Boundaries`, results typically agree
+    with :class:`ModelHHSolver` to within a relative error of about ``1e-11``,
+    but for poorly conditioned transition matrices this error can reach
+    ``1e-5`` or more.
+
+    The ``protocol`` can be given as a :class:`myokit.Protocol` or a
+    :class:`CompiledProtocol`.
+
+    If ``single_precision`` is set to ``True``, :meth:`set_loose` can be used
+    to switch to single precision, as in :class:`ModelHHSolver`. The
+    decompositions are always calculated in double precision.
+    """
 
-        # Reset, apply parameters, and run
-        self.sim.reset()
-        self.sim.set_parameters(parameters)
-        tmax = times[-1] + (times[-1] - times[-2])
-        log = self.sim.run(tmax, log_times=times)
-        return log['ikr.IKr']
+    def __init__(self, protocol, single_precision=False):
+
+        # Get the (cached) Markov model's steady state and reversal potential
+        _, _, y0, ek = _ion_current('beattie-2017-ikr-markov.mmt', 'markov')
+
+        # Store protocol
+        self._compiled = None
+        if isinstance(protocol, CompiledProtocol):
+            self._compiled = protocol
+            protocol = protocol.protocol()
+        self._protocol = protocol.clone()
+
+        # Use the -80mV steady state as the initial state
+        self._x0 = np.array([y0['ikr.y' + str(1 + i)] for i in range(4)])
+
+        # Store reversal potential
+        self._ek = ek
+
+        # Precision
+        self._single_precision = bool(single_precision)
+        self._loose = False
+
+    def loose(self):
+        """ Returns ``True`` if single precision is currently used. """
+        return self._loose
+
+    def n_parameters(self):
+        return 9
+
+    def set_loose(self, loose):
+        """
+        Selects single (``True``) or double (``False``) precision. This has no
+        effect if ``single_precision`` was not set.
+        """
+        if self._single_precision:
+            self._loose = bool(loose)
+
+    def simulate(self, parameters, times):
+        return self.simulate_batch([parameters], times)[0]
+
+    def simulate_batch(self, parameters, times):
+        """
+        Runs simulations for ``n`` parameter vectors at once, and returns an
+        array of shape ``(n, len(times))``.
+
+        Parameters
+        ----------
+        parameters
+            An array of shape ``(n, 9)``.
+        times
+            A non-decreasing sequence of times to evaluate at.
+        """
+        p = np.array(parameters, dtype=float, ndmin=2)
+
+        # Compile protocol, if needed
+        if self._compiled is None or not self._compiled.matches(times):
+            self._compiled = CompiledProtocol(self._protocol, times)
+
+        return self._sweep(p, self._compiled)
+
+    def sum_of_squares_batch(self, parameters, times, values):
+        """
+        Returns the sum of squared differences between the simulated current
+        and ``values`` for ``n`` parameter vectors at once, as an array of
+        length ``n``.
+
+        The residuals are calculated and reduced one protocol step at a time,
+        so that no full current traces are stored.
+
+        Parameters
+        ----------
+        parameters
+            An array of shape ``(n, 9)``.
+        times
+            A non-decreasing sequence of times to evaluate at.
+        values
+            The data to compare to, with one value per time.
+        """
+        p = np.array(parameters, dtype=float, ndmin=2)
+        values = np.asarray(values, dtype=float)
+        if values.shape != np.shape(times):
+            raise ValueError('Times and values must have the same shapes.')
+
+        # Compile protocol, if needed
+        if self._compiled is None or not self._compiled.matches(times):
+            self._compiled = CompiledProtocol(self._protocol, times)
+
+        return np.sum(self._sweep(p, self._compiled, data=values), axis=1)
+
+    @staticmethod
+    def _decompose(p, voltages):
+        """
+        Returns the eigenvalues ``l`` (shape ``(n, m, 4)``), eigenvectors
+        ``V`` and their inverses (both with shape ``(n, m, 4, 4)``) of the
+        transition matrices for ``n`` parameter vectors ``p`` at ``m``
+        ``voltages``.
+
+        Matrices that contain non-finite entries or that cannot be decomposed
+        get NaN results, without affecting the rest of the batch.
+        """
+        v = np.asarray(voltages, dtype=float)[None, :]
+        k12 = p[:, 0:1] * np.exp(p[:, 1:2] * v)
+        k21 = p[:, 2:3] * np.exp(-p[:, 3:4] * v)
+        k41 = p[:, 4:5] * np.exp(p[:, 5:6] * v)
+        k14 = p[:, 6:7] * np.exp(-p[:, 7:8] * v)
+
+        # Transition matrices, with dx/dt = A x
+        A = np.zeros(k12.shape + (4, 4))
+        A[..., 0, 0] = -(k12 + k14)
+        A[..., 0, 1] = k21
+        A[..., 0, 3] = k41
+        A[..., 1, 0] = k12
+        A[..., 1, 1] = -(k14 + k21)
+        A[..., 1, 2] = k41
+        A[..., 2, 1] = k14
+        A[..., 2, 2] = -(k21 + k41)
+        A[..., 2, 3] = k12
+        A[..., 3, 0] = k14
+        A[..., 3, 2] = k21
+        A[..., 3, 3] = -(k12 + k41)
+
+        # Decompose. The eigenvalues of this scheme are real, but numpy
+        # returns complex results if rounding errors say otherwise.
+        def decompose(A):
+            l, V = np.linalg.eig(A)
+            return l, V, np.linalg.inv(V)
+
+        # Decompose all finite matrices at once, or one at a time if that
+        # fails, and use NaN for any matrices that can't be decomposed
+        ok = np.all(np.isfinite(A), axis=(-2, -1))
+        try:
+            parts = [(ok, decompose(A[ok]))]
+        except np.linalg.LinAlgError:
+            parts = []
+            for i in zip(*np.nonzero(ok)):
+                try:
+                    parts.append((i, decompose(A[i])))
+                except np.linalg.LinAlgError:
+                    pass
+        l_shape = A.shape[:-1]
+        out = [np.full(s, np.nan) for s in (l_shape, A.shape, A.shape)]
+        for i, results in parts:
+            for k, x in enumerate(results):
+                if np.iscomplexobj(x) and not np.iscomplexobj(out[k]):
+                    out[k] = out[k].astype(complex)
+                out[k][i] = x
+        return tuple(out)
+
+    @_profiled('simulate.markov')
+    def _sweep(self, p, compiled, resets=(), data=None):
+        """
+        Evaluates the solution for parameters ``p`` (with shape ``(n, 9)``) on
+        a compiled protocol, and returns an array of shape ``(n,
+        len(compiled.times()))``.
+
+        At the start of every step whose index is in ``resets`` the states are
+        set back to their initial values.
+
+        If ``data`` is given, an array of shape ``(n, len(compiled))`` is
+        returned instead, containing the sum of squared differences between
+        current and data in each step (see :meth:`ModelHHSolver._sweep`).
+        """
+        lo, hi = compiled.ranges()
+        offsets = compiled.offsets()
+        duration = compiled.duration()
+        if self._loose:
+            offsets, duration = _single(offsets), _single(duration)
+            if data is not None:
+                data = _single(data)
+
+        # Decompose the transition matrix at every voltage
+        levels, index = compiled.levels()
+        with np.errstate(all='ignore'):
+            ls, Vs, Vis = self._decompose(p, levels)
+
+        # Select precision, and get the driving term for every step
+        if self._loose:
+            dtype = np.complex64 if np.iscomplexobj(ls) else np.float32
+            ls, Vs, Vis = [x.astype(dtype) for x in (ls, Vs, Vis)]
+        drive = p[:, 8:9] * (compiled.voltage() - self._ek)
+        drive = drive.astype(ls.real.dtype, copy=False)
+
+        # Initial states, for each parameter vector
+        n = len(p)
+        x0 = self._x0.astype(ls.dtype)
+        x = np.tile(x0, (n, 1))
+        resets = set(resets)
+
+        # Evaluate the solution step by step, using work arrays to avoid
+        # allocating temporary arrays for every step
+        m = np.max(hi - lo) if len(lo) else 0
+        ex = np.empty((n, 4, m), dtype=ls.dtype)
+        if data is None:
+            current = np.empty((n, len(compiled.times())), dtype=ls.dtype)
+        else:
+            current = np.zeros((n, len(compiled)))
+            cx = np.empty((n, m), dtype=ls.dtype)
+            rx = np.empty((n, m), dtype=ls.real.dtype)
+        for i in range(len(compiled)):
+            j = index[i]
+            l, V, Vi = ls[:, j], Vs[:, j], Vis[:, j]
+            if i in resets:
+                x = np.tile(x0, (n, 1))
+
+            # Write the state as a sum of eigenvectors
+            a = np.einsum('nij,nj->ni', Vi, x)
+
+            # Evaluate current at the logged times within this step, using
+            # only the open state (y3)
+            if hi[i] > lo[i]:
+                dt = offsets[lo[i]:hi[i]]
+                e = ex[:, :, :len(dt)]
+                np.multiply(l[:, :, None], dt, out=e)
+                np.exp(e, out=e)
+                c = V[:, 2, :] * a * drive[:, i:i + 1]
+                if data is None:
+                    np.einsum('nk,nkt->nt', c, e, out=current[:, lo[i]:hi[i]])
+                else:
+                    y, r = cx[:, :len(dt)], rx[:, :len(dt)]
+                    np.einsum('nk,nkt->nt', c, e, out=y)
+                    np.subtract(np.real(y), data[lo[i]:hi[i]], out=r)
+                    current[:, i] = np.einsum('nt,nt->n', r, r)
+
+            # Update states to the end of the step
+            x = np.einsum('nij,nj->ni', V, a * np.exp(l * duration[i]))
+
+        return np.real(current)
+
+
+class DiscreteEnsemble(object):
+    """
+    Simulates an ensemble of independent stochastic realisations of the Markov
+    model by Beattie et al., with a finite number of channels, on a step
+    protocol.
+
+    Unlike :class:`myokit.lib.markov.DiscreteSimulation`, which runs a single
+    realisation with Gillespie's method, all realisations are advanced
+    together. The numbers of channels in each state are only sampled at the
+    log times and at the start of each step: as channels move independently,
+    the counts after a time ``dt`` follow from multinomial draws with the
+    transition probabilities ``P(dt) = V exp(l dt) V^-1`` (using the
+    eigendecomposition from :class:`ModelMarkovSolver`), which is exact and
+    does not require simulating every transition.
+
+    The cost therefore scales with the number of log times (and with the
+    number of transitions per log interval), rather than with the total
+    number of transitions.
+
+    Every realisation draws its random numbers from its own stream, spawned
+    from a single seed, so that a realisation's result depends only on the
+    seed and its index, and not on the number of realisations simulated.
+
+    Parameters
+    ----------
+    protocol
+        A :class:`myokit.Protocol` or a :class:`CompiledProtocol`.
+    n_channels
+        The number of channels in each realisation.
+    """
+    # Maximum number of channels per inverted binomial draw
+    _chunk = 512
+
+    def __init__(self, protocol, n_channels):
+        self._n_channels = int(n_channels)
+        if self._n_channels < 1:
+            raise ValueError('Number of channels must be at least 1.')
+        self._n_chunks = -(-self._n_channels // self._chunk)
+        self._model = ModelMarkovSolver(protocol)
+
+    def n_channels(self):
+        """ Returns the number of channels in each realisation. """
+        return self._n_channels
+
+    def n_parameters(self):
+        return 9
+
+    def simulate(self, parameters, times, n_realisations=1, seed=None):
+        """
+        Runs ``n_realisations`` stochastic simulations, and returns an array
+        of shape ``(n_realisations, len(times))`` containing the current in
+        each realisation.
+
+        Parameters
+        ----------
+        parameters
+            A single parameter vector.
+        times
+            A non-decreasing sequence of times to evaluate at.
+        n_realisations
+            The number of realisations to simulate.
+        seed
+            An optional seed for the random number streams.
+        """
+        p = np.array(parameters, dtype=float)
+        if p.shape != (9, ):
+            raise ValueError('Expecting a single vector of 9 parameters.')
+        n = int(n_realisations)
+        if n < 1:
+            raise ValueError('Number of realisations must be at least 1.')
+
+        # Compile protocol, if needed
+        model = self._model
+        if model._compiled is None or not model._compiled.matches(times):
+            model._compiled = CompiledProtocol(model._protocol, times)
+        compiled = model._compiled
+        lo, hi = compiled.ranges()
+        offsets = compiled.offsets()
+        duration = compiled.duration()
+
+        # Decompose the transition matrix at every voltage
+        levels, index = compiled.levels()
+        with np.errstate(all='ignore'):
+            ls, Vs, Vis = model._decompose(p[None, :], levels)
+
+        # Create a stream of random numbers for each realisation
+        streams = [
+            np.random.default_rng(s)
+            for s in np.random.SeedSequence(seed).spawn(n)]
+        uniforms = self._uniforms(streams)
+
+        # Sample initial states from the -80mV steady state
+        counts = np.zeros((n, 4), dtype=int)
+        counts[:, 0] = self._n_channels
+        start = np.zeros((4, 4))
+        start[:, 0] = model._x0
+        counts = self._transition(counts, start, next(uniforms))
+
+        # Sample states at each log time, and at the end of every step
+        current = np.empty((n, len(compiled.times())))
+        scale, ek = p[8] / self._n_channels, model._ek
+        for i, v in enumerate(compiled.voltage()):
+            j = index[i]
+            probabilities = {}
+            t = offsets[lo[i]:hi[i]]
+            dts = np.diff(t, prepend=0)
+            for k, dt in enumerate(dts):
+                if dt > 0:
+                    counts = self._transition(
+                        counts, self._probabilities(
+                            probabilities, dt, ls[0, j], Vs[0, j], Vis[0, j]),
+                        next(uniforms))
+                current[:, lo[i] + k] = counts[:, 2] * (scale * (v - ek))
+            dt = duration[i] - (t[-1] if len(t) else 0)
+            if dt > 0:
+                counts = self._transition(
+                    counts, self._probabilities(
+                        probabilities, dt, ls[0, j], Vs[0, j], Vis[0, j]),
+                    next(uniforms))
+
+        return current
+
+    @staticmethod
+    def _binomial(n, q, u):
+        """
+        Returns binomial samples for arrays of counts ``n`` and probabilities
+        ``q``, by inverting the cumulative distribution at uniformly
+        distributed ``u`` (all arrays must have the same shape).
+
+        The inversion starts at zero, so that its cost scales with the number
+        of successes (or, for ``q > 0.5``, failures). Counts are kept small
+        enough for ``(1 - q)**n`` not to underflow.
+        """
+        shape = n.shape
+        n, q, u = n.ravel(), q.ravel(), u.ravel()
+        flip = q > 0.5
+        q = np.where(flip, 1 - q, q)
+        r = q / (1 - q)
+        pmf = (1 - q)**n
+        cdf = pmf.copy()
+        k = np.zeros(n.shape, dtype=int)
+
+        # Step through k = 1, 2, ..., for the samples that need it
+        i = np.flatnonzero((u > cdf) & (n > 0))
+        while len(i):
+            k[i] += 1
+            pmf[i] *= (n[i] - k[i] + 1) / k[i] * r[i]
+            cdf[i] += pmf[i]
+            i = i[(u[i] > cdf[i]) & (k[i] < n[i])]
+        return np.where(flip, n - k, k).reshape(shape)
+
+    @staticmethod
+    def _probabilities(cache, dt, lam, V, Vi):
+        """
+        Returns the transition probabilities ``P[j, i]`` (from state ``i`` to
+        ``j``) for a time ``dt``, given the eigenvalues ``lam``, eigenvectors
+        ``V`` and their inverse ``Vi``, using a ``cache`` dict.
+        """
+        try:
+            return cache[dt]
+        except KeyError:
+            pass
+        P = np.real(np.dot(V * np.exp(lam * dt), Vi))
+        P = np.clip(P, 0, 1)
+        P /= np.sum(P, axis=0)
+        cache[dt] = P
+        return P
+
+    def _transition(self, counts, P, u):
+        """
+        Moves the channels in each realisation (with ``counts`` of shape
+        ``(n, 4)``) according to the transition probabilities ``P``, using
+        uniform random numbers ``u`` of shape ``(n, 4, 3, n_chunks)``.
+
+        For every state, the number of channels leaving is drawn first. These
+        channels are then divided over the other states using conditional
+        binomial draws, which are only made where any channels left.
+        """
+        states = np.arange(4)
+        nc = self._n_chunks
+
+        # Draw the number of channels leaving each state, splitting large
+        # counts into chunks
+        m = np.clip(
+            counts[:, :, None] - self._chunk * np.arange(nc), 0, self._chunk)
+        leave = np.clip(1 - P[states, states], 0, 1)
+        x = self._binomial(
+            m, np.broadcast_to(leave[None, :, None], m.shape).copy(),
+            u[:, :, 0])
+        new = counts - np.sum(x, axis=2)
+
+        # Divide the leaving channels over the other states
+        i = np.flatnonzero(x)
+        if len(i):
+            left = x.ravel()[i]
+            row, source, chunk = i // (4 * nc), (i // nc) % 4, i % nc
+            rest = leave[source]
+            for k in range(2):
+                target = (source + 1 + k) % 4
+                p = P[target, source]
+                q = np.zeros(len(i))
+                ok = rest > 0
+                q[ok] = np.minimum(p[ok] / rest[ok], 1)
+                y = self._binomial(left, q, u[row, source, 1 + k, chunk])
+                np.add.at(new, (row, target), y)
+                left -= y
+                rest -= p
+            np.add.at(new, (row, (source + 3) % 4), left)
+        return new
+
+    def _uniforms(self, streams, size=None):
+        """
+        Yields arrays of uniform random numbers of shape ``(n, 4, 3,
+        n_chunks)``, where the ``i``-th row is drawn from ``streams[i]``.
+
+        Numbers are drawn in blocks of ``size`` arrays, and each yielded array
+        is only valid until the next one is requested.
+        """
+        shape = (4, 3, self._n_chunks)
+        if size is None:
+            size = max(16, 2**22 // (len(streams) * 12 * self._n_chunks))
+        block = np.empty((len(streams), size) + shape)
+        while True:
+            for s, b in zip(streams, block):
+                s.random(out=b)
+            for t in range(size):
+                yield block[:, t]
+
+
+class MeanSquaredError(pints.MeanSquaredError):
+    """
+    A :class:`pints.MeanSquaredError` for single-output problems that can
+    evaluate a whole population of parameter vectors at once.
+
+    If the problem's model has a ``sum_of_squares_batch`` method (such as
+    :class:`ModelHHSolver`) this is used to calculate all errors in a single
+    call, without storing the simulated currents. Otherwise, if the model has
+    a ``simulate_batch`` method this is used to run all simulations at once,
+    and if not they are run one by one.
+    """
+    def __init__(self, problem):
+        if problem.n_outputs() != 1:
+            raise ValueError('Only single-output problems are supported.')
+        super().__init__(problem)
+
+    @_profiled('error')
+    def evaluate_batch(self, parameters):
+        """
+        Returns the errors for each parameter vector (each row) in
+        ``parameters``.
+        """
+        model = self._problem.model()
+        if hasattr(model, 'sum_of_squares_batch'):
+            return self._ninv * model.sum_of_squares_batch(
+                parameters, self._times, self._values)
+        elif hasattr(model, 'simulate_batch'):
+            values = model.simulate_batch(parameters, self._times)
+        else:
+            values = np.array(
+                [model.simulate(p, self._times) for p in parameters])
+        return self._ninv * np.sum((values - self._values)**2, axis=1)
+
+
+class MultiProtocolError(pints.ErrorMeasure):
+    """
+    Calculates a weighted sum of (root) mean squared errors on several step
+    protocols, using a single :class:`ModelHHSolver` sweep for all protocols.
+
+    The step tables of all protocols are concatenated (with the states reset
+    at the start of each protocol), and rates are calculated once for all the
+    voltages used in any of the protocols. The result equals that of a
+    :class:`pints.SumOfErrors` of :class:`pints.MeanSquaredError` (or
+    :class:`pints.RootMeanSquaredError`) measures on each protocol, but costs
+    roughly one simulation per evaluation.
+
+    Parameters
+    ----------
+    protocols
+        A sequence of :class:`myokit.Protocol` or :class:`CompiledProtocol`
+        objects.
+    times
+        A sequence containing the log times for each protocol.
+    values
+        A sequence containing the data to fit to for each protocol.
+    weights
+        An optional sequence of weights for each protocol's error.
+    root
+        Set to ``True`` to use root mean squared errors.
+    """
+    def __init__(self, protocols, times, values, weights=None, root=False):
+
+        # Check input
+        if not (len(protocols) == len(times) == len(values)):
+            raise ValueError(
+                'Protocols, times, and values must have the same length.')
+        if len(protocols) < 1:
+            raise ValueError('At least one protocol must be given.')
+        if weights is None:
+            weights = np.ones(len(protocols))
+        self._weights = np.array(weights, dtype=float)
+        if self._weights.shape != (len(protocols), ):
+            raise ValueError('Expecting one weight per protocol.')
+        self._root = bool(root)
+
+        # Compile protocols, and concatenate them
+        compiled = []
+        for protocol, t in zip(protocols, times):
+            if not (isinstance(protocol, CompiledProtocol)
+                    and protocol.matches(t)):
+                if isinstance(protocol, CompiledProtocol):
+                    protocol = protocol.protocol()
+                protocol = CompiledProtocol(protocol, t)
+            compiled.append(protocol)
+        self._compiled = _ConcatenatedProtocol(compiled)
+
+        # Store concatenated data, and the start and size of each part
+        self._values = np.concatenate(
+            [np.array(v, dtype=float) for v in values])
+        if self._values.shape != self._compiled.times().shape:
+            raise ValueError('Times and values must have the same shapes.')
+        self._starts, self._sizes = self._compiled.parts()
+        if np.any(self._sizes == 0):
+            raise ValueError('Each protocol needs at least one log time.')
+
+        # Create model
+        self._model = ModelHHSolver(compiled[0])
+
+    def __call__(self, x):
+        return self.evaluate_batch([x])[0]
+
+    @_profiled('error')
+    def evaluate_batch(self, parameters):
+        """
+        Evaluates the error for ``n`` parameter vectors at once, and returns
+        an array of length ``n``.
+        """
+        p = np.array(parameters, dtype=float, ndmin=2)
+        resets = self._compiled.resets()
+        errors = self._model._sweep(p, self._compiled, resets, self._values)
+        errors = np.add.reduceat(errors, resets, axis=1) / self._sizes
+        if self._root:
+            errors = np.sqrt(errors)
+        return np.dot(errors, self._weights)
+
+    def n_parameters(self):
+        return 9
+
+    def simulate(self, parameters):
+        """
+        Runs a simulation for every protocol, and returns a list of current
+        arrays.
+        """
+        current = self._model._sweep(
+            np.array(parameters, dtype=float, ndmin=2), self._compiled,
+            self._compiled.resets())[0]
+        return [current[i:i + n] for i, n in zip(self._starts, self._sizes)]
+
+
+class MultiResolutionError(pints.ErrorMeasure):
+    """
+    A mean squared error that is first evaluated on a decimated subset of a
+    problem's times, and then on the full trace.
+
+    The coarse error uses every ``factor``-th time point (after removing any
+    points excluded by ``mask``), and is a mean over these points, so that it
+    has the same scale as the full error. When used with :meth:`fit`, the
+    optimiser switches to the full error once its step size falls below
+    ``switch`` times its initial value, so that the final result is found
+    using the full error.
+
+    If the problem's model has a ``set_loose`` method (e.g. a
+    :class:`ModelCVODESolver` with a ``loose_tolerance``, or a
+    :class:`ModelHHSolver` with ``single_precision=True``), it uses its loose
+    tolerances or reduced precision while the coarse error is selected. With
+    ``factor=1`` this gives an error that only changes the solver settings.
+
+    If the model can't simulate a batch of parameter vectors at once (e.g. a
+    :class:`ModelCVODESolver`), :meth:`fit` evaluates this error using a
+    :class:`WorkerPool`, and selects the coarse or full error in every worker
+    with :meth:`WorkerPool.set_coarse`.
+
+    Parameters
+    ----------
+    problem
+        A :class:`pints.SingleOutputProblem`.
+    factor
+        The decimation factor for the coarse error.
+    mask
+        An optional boolean array, with one entry per time point, set to
+        ``False`` for any points to exclude from the coarse error (e.g. a mask
+        created with :meth:`capacitance_mask`).
+    switch
+        The step size, relative to the initial step size, at which to switch
+        to the full error.
+    """
+    def __init__(self, problem, factor=10, mask=None, switch=0.1):
+        factor = int(factor)
+        if factor < 1:
+            raise ValueError('Decimation factor must be at least 1.')
+        self._switch = float(switch)
+        if not 0 < self._switch < 1:
+            raise ValueError('Switch must be greater than 0 and less than 1.')
+
+        # Select coarse time points
+        times, values = problem.times(), problem.values()
+        if mask is None:
+            index = np.arange(0, len(times), factor)
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != times.shape:
+                raise ValueError('Mask must have one entry per time point.')
+            index = np.nonzero(mask)[0][::factor]
+
+        # Create errors, using a copy of the model for the coarse problem so
+        # that any protocols compiled for either set of times are kept
+        coarse = pints.SingleOutputProblem(
+            copy.copy(problem.model()), times[index], values[index])
+        self._coarse_error = MeanSquaredError(coarse)
+        self._full_error = MeanSquaredError(problem)
+        self.set_coarse(True)
+
+    def __call__(self, x):
+        if self._coarse:
+            return self._coarse_error(x)
+        return self._full_error(x)
+
+    def coarse(self):
+        """ Returns ``True`` if the coarse error is currently used. """
+        return self._coarse
+
+    def evaluate_batch(self, parameters):
+        """ See :meth:`MeanSquaredError.evaluate_batch()`. """
+        if self._coarse:
+            return self._coarse_error.evaluate_batch(parameters)
+        return self._full_error.evaluate_batch(parameters)
+
+    def full_error(self):
+        """ Returns the error on the full trace. """
+        return self._full_error
+
+    def n_parameters(self):
+        return self._full_error.n_parameters()
+
+    def set_coarse(self, coarse):
+        """ Selects the coarse (``True``) or full (``False``) error. """
+        self._coarse = bool(coarse)
+        for error in (self._coarse_error, self._full_error):
+            model = error._problem.model()
+            if hasattr(model, 'set_loose'):
+                model.set_loose(self._coarse)
+
+    def switch(self):
+        """
+        Returns the relative step size at which to switch to the full error.
+        """
+        return self._switch
+
+
+def _has_batch(error):
+    """
+    Returns ``True`` if ``error`` can evaluate a whole population at once
+    (rather than one simulation at a time), so that a :class:`WorkerPool`
+    would not speed it up.
+    """
+    if isinstance(error, MultiResolutionError):
+        error = error.full_error()
+    if isinstance(error, MeanSquaredError):
+        model = error._problem.model()
+        return (hasattr(model, 'sum_of_squares_batch')
+                or hasattr(model, 'simulate_batch'))
+    return hasattr(error, 'evaluate_batch')
+
+
+def capacitance_mask(protocol, times, duration=5):
+    """
+    Returns a boolean array that is ``False`` for all ``times`` within
+    ``duration`` ms after a voltage step in ``protocol``, where capacitance
+    artefacts are expected, and ``True`` everywhere else.
+
+    Parameters
+    ----------
+    protocol
+        A :class:`myokit.Protocol` or :class:`CompiledProtocol`.
+    times
+        The non-decreasing sequence of times to create a mask for.
+    duration
+        The duration (in ms) to mask after each step.
+    """
+    times = np.asarray(times, dtype=float)
+    if not isinstance(protocol, CompiledProtocol):
+        protocol = CompiledProtocol(protocol, times)
+
+    # Find the times at which the voltage changes
+    v, t = protocol.voltage(), protocol.start()
+    t = t[1:][v[1:] != v[:-1]]
+
+    # Mask all times in [t, t + duration)
+    lo = np.searchsorted(times, t)
+    hi = np.searchsorted(times, t + duration)
+    change = np.zeros(len(times) + 1, dtype=int)
+    np.add.at(change, lo, 1)
+    np.add.at(change, hi, -1)
+    return np.cumsum(change[:-1]) == 0
+
+
+class _ConcatenatedProtocol(object):
+    """
+    Concatenates several :class:`CompiledProtocol` objects into a single step
+    table with the same interface, for use in :meth:`ModelHHSolver._sweep`.
+
+    Log times are concatenated too, so that ``times()`` is no longer
+    non-decreasing. The steps at which each protocol starts are returned by
+    :meth:`resets`.
+    """
+    def __init__(self, compiled):
+        sizes = np.array([len(c.times()) for c in compiled])
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        self._starts, self._sizes = starts, sizes
+        self._resets = np.cumsum([0] + [len(c) for c in compiled[:-1]])
+
+        self._times = np.concatenate([c.times() for c in compiled])
+        self._duration = np.concatenate([c.duration() for c in compiled])
+        self._voltage = np.concatenate([c.voltage() for c in compiled])
+        self._offsets = np.concatenate([c.offsets() for c in compiled])
+        self._lo = np.concatenate(
+            [c.ranges()[0] + s for c, s in zip(compiled, starts)])
+        self._hi = np.concatenate(
+            [c.ranges()[1] + s for c, s in zip(compiled, starts)])
+        self._levels, self._level_index = np.unique(
+            self._voltage, return_inverse=True)
+
+    def __len__(self):
+        return len(self._voltage)
+
+    def duration(self):
+        return self._duration
+
+    def levels(self):
+        return self._levels, self._level_index
+
+    def offsets(self):
+        return self._offsets
+
+    def parts(self):
+        """
+        Returns a tuple ``(starts, sizes)`` with the index of each protocol's
+        first log time, and its number of log times.
+        """
+        return self._starts, self._sizes
+
+    def ranges(self):
+        return self._lo, self._hi
+
+    def resets(self):
+        """ Returns the index of the first step of each protocol. """
+        return self._resets
+
+    def times(self):
+        return self._times
+
+    def voltage(self):
+        return self._voltage
+
+
+class BatchEvaluator(pints.Evaluator):
+    """
+    A :class:`pints.Evaluator` that evaluates all positions with a single call
+    to ``function.evaluate_batch()``, for example using a
+    :class:`MeanSquaredError`.
+
+    Parameters
+    ----------
+    function
+        An object with an ``evaluate_batch`` method.
+    transformation
+        An optional :class:`pints.Transformation`. If given, all positions are
+        assumed to be in the search space, and will be transformed to the model
+        space before evaluation.
+    log_pdf
+        If ``function`` returns the values of a :class:`pints.LogPDF`, this
+        log pdf should be passed in, so that its values are converted to
+        errors ``-log(pdf)``. As in
+        :meth:`pints.Transformation.convert_log_pdf`, the log of the
+        transformation's Jacobian is added to the log pdf, unless it is a
+        :class:`pints.LogLikelihood`.
+    """
+    def __init__(self, function, transformation=None, log_pdf=None):
+        super().__init__(function)
+        self._transformation = transformation
+        self._log_pdf = log_pdf is not None
+        self._jacobian = transformation is not None and not isinstance(
+            log_pdf, (type(None), pints.LogLikelihood))
+
+    def _evaluate(self, positions):
+        if len(positions) == 0:
+            return []
+        ys = positions
+        if self._transformation is not None:
+            positions = self._to_model(positions)
+        fs = np.asarray(
+            self._function.evaluate_batch(np.array(positions)), dtype=float)
+        if self._log_pdf:
+            if self._jacobian:
+                fs = fs + [
+                    self._transformation.log_jacobian_det(y) for y in ys]
+            fs = -fs
+        return list(fs)
+
+    @_profiled('transformation')
+    def _to_model(self, positions):
+        """ Transforms ``positions`` from the search to the model space. """
+        return [self._transformation.to_model(x) for x in positions]
+
+
+class WorkerPool(object):
+    """
+    A pool of long-lived worker processes, each of which creates an error
+    measure once and then evaluates the parameter vectors sent to it.
+
+    Unlike a :class:`pints.ParallelEvaluator`, a pool can be reused for many
+    optimisations (e.g. all repeats in :meth:`fit`), so that processes are
+    started, and models are built (and compiled), only once.
+
+    A pool can be used wherever an error with an ``evaluate_batch`` method is
+    expected (e.g. in a :class:`BatchEvaluator`), and should be closed when no
+    longer needed, either with :meth:`close` or by using it as a context
+    manager::
+
+        with WorkerPool(create_error, n_workers=8) as pool:
+            fit('results', error, boundaries, pool=pool, repeats=10)
+
+    Parameters
+    ----------
+    create_error
+        A callable that returns the error to evaluate. This is called once in
+        every worker. When the ``spawn`` start method is used, it must be
+        picklable (e.g. a module-level function).
+    args
+        An optional sequence of arguments to pass to ``create_error``.
+    n_workers
+        The number of worker processes (default is the number of cores).
+    """
+    def __init__(self, create_error, args=None, n_workers=None):
+
+        if n_workers is None:
+            n_workers = pints.ParallelEvaluator.cpu_count()
+        self._n_workers = int(n_workers)
+        if self._n_workers < 1:
+            raise ValueError('Number of workers must be at least 1.')
+
+        # Start workers, each with its own seed. Tasks and results are tagged
+        # with a batch number, so that any left over from an interrupted batch
+        # are skipped by the workers and ignored by later batches.
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._batch = multiprocessing.Value('l', 0, lock=False)
+        self._coarse = None
+        args = () if args is None else tuple(args)
+        seeds = np.random.randint(0, 2**31, self._n_workers)
+        self._workers = []
+        for seed in seeds:
+            w = multiprocessing.Process(
+                target=_pool_worker,
+                args=(create_error, args, seed, self._tasks, self._results,
+                      self._batch))
+            w.daemon = True
+            w.start()
+            self._workers.append(w)
+
+    def __call__(self, x):
+        return self.evaluate_batch([x])[0]
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Stops all worker processes. """
+        for w in self._workers:
+            self._tasks.put(None)
+        for w in self._workers:
+            w.join(1)
+            if w.is_alive():
+                w.terminate()
+        self._workers = []
+
+    def evaluate_batch(self, parameters):
+        """
+        Evaluates the error for each parameter vector in ``parameters``, and
+        returns a list of the results.
+        """
+        if not self._workers:
+            raise RuntimeError('Worker pool has been closed.')
+
+        # Start a new batch, and ask workers to send back a profile if
+        # profiling
+        self._batch.value += 1
+        batch = self._batch.value
+        profiler = _profiler
+        for k, x in enumerate(parameters):
+            self._tasks.put((batch, k, x, self._coarse, profiler is not None))
+
+        results = [None] * len(parameters)
+        for i in range(len(parameters)):
+            while True:
+                try:
+                    b, k, f, trace, profile = self._results.get(timeout=1)
+                except queue.Empty:
+                    if not all(w.is_alive() for w in self._workers):
+                        self.close()
+                        raise RuntimeError('Worker process terminated.')
+                    continue
+                if b is None or b == batch:
+                    break
+            if trace is not None:
+                self.close()
+                raise Exception(
+                    'Exception in subprocess:\n' + trace
+                    + '\nException in subprocess')
+            results[k] = f
+            if profile is not None:
+                profiler.merge(profile)
+        return results
+
+    def n_workers(self):
+        """ Returns the number of worker processes in this pool. """
+        return self._n_workers
+
+    def set_coarse(self, coarse):
+        """
+        Selects the coarse (``True``) or full (``False``) error in every
+        worker, for pools that evaluate a :class:`MultiResolutionError`. The
+        setting is sent along with every following task.
+        """
+        self._coarse = bool(coarse)
+
+
+def _pool_worker(create_error, args, seed, tasks, results, batch):
+    """
+    Runs a :class:`WorkerPool` worker process.
+
+    Tasks from any batch other than the current ``batch.value`` are skipped.
+    If a task sets ``coarse``, the error's ``set_coarse`` method is called
+    before evaluating it (see :meth:`WorkerPool.set_coarse`).
+    The worker stops when it receives ``None``, or when its parent process
+    has ended.
+    If a task asks for it, the evaluation is profiled and the profile (with
+    the time spent in the worker as ``pool.worker``) is sent back with the
+    result.
+    """
+    # Use the default handling of SIGTERM, even if the parent process (e.g. a
+    # child process in fit()) changed it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    parent = os.getppid()
+
+    np.random.seed(seed)
+    try:
+        error = create_error(*args)
+    except Exception:
+        results.put((None, None, None, traceback.format_exc(), None))
+        return
+    while True:
+        try:
+            task = tasks.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent:
+                return
+            continue
+        if task is None:
+            return
+        b, k, x, coarse, profile = task
+        if b != batch.value:
+            continue
+        if coarse is not None and coarse != error.coarse():
+            error.set_coarse(coarse)
+        try:
+            if profile:
+                with Profiler() as profiler:
+                    t = time.perf_counter()
+                    f = error(x)
+                    profiler.add_time('pool.worker', time.perf_counter() - t)
+                results.put((b, k, f, None, profiler.to_dict()))
+            else:
+                results.put((b, k, error(x), None, None))
+        except Exception:
+            results.put((b, k, None, traceback.format_exc(), None))
 
 
 def create_log_transformation(self):
@@ -390,6 +2369,148 @@ def create_log_transformation(self):
     )
 
 
+class CapReached(Exception):
+    """
+    Raised by :class:`reserve_base_name` if the maximum number of results has
+    already been reached.
+    """
+
+
+class RunCounter(object):
+    """
+    Allocates run indices for a template path, and keeps count of the number
+    of runs, in a small counter file protected by a file lock.
+
+    For a template path ``output/result.txt`` the counter is stored in
+    ``output/.result.count``, as two integers: the last indice handed out,
+    and the number of reserved or finished runs. Every operation locks this
+    file (using POSIX record locks, which also work on network file systems
+    that support them, e.g. NFS with ``lockd``), so that reserving a run and
+    checking the cap costs a constant amount of work, regardless of the
+    number of results already in the directory.
+
+    The first time a counter is used for a template, it is initialised by
+    scanning the directory once. Because results can be deleted without
+    updating the counter, the directory is scanned again whenever the result
+    file for the last indice handed out is missing (e.g. after all results
+    were deleted), and before a cap is enforced.
+
+    Parameters
+    ----------
+    template_path
+        A template path, e.g. ``output/result.txt``.
+    """
+    def __init__(self, template_path):
+        dirname, basename = os.path.split(template_path)
+        basename = os.path.splitext(basename)[0]
+        self._template_path = template_path
+        self._path = os.path.join(dirname, '.' + basename + '.count')
+
+        # Indice formatting, as used by reserve_base_name
+        self._format = '-{:03d}'
+
+    def _locked(self, update=None, check=True):
+        """
+        Opens and locks the counter file, reads the stored ``(indice, n)``,
+        and calls ``update(indice, n)``. If this returns a new ``(indice, n)``
+        it is written back before the lock is released. Returns the stored
+        ``(indice, n)`` after updating.
+
+        If ``check`` is ``True``, the directory is scanned again if the stored
+        values are out of date (see :meth:`_stale`).
+        """
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            data = os.read(fd, 100).split()
+            scanned = True
+            if len(data) != 2:
+                stored = self._scan()
+            else:
+                stored = int(data[0]), int(data[1])
+                scanned = check and self._stale(*stored)
+                if scanned:
+                    stored = self._scan()
+            new = None if update is None else update(*stored)
+            if new is not None or scanned:
+                stored = stored if new is None else new
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, '{} {}\n'.format(*stored).encode())
+                os.fsync(fd)
+            return stored
+        finally:
+            os.close(fd)    # Releases the lock
+
+    def _scan(self):
+        """
+        Scans the directory for existing results, and returns the highest
+        indice and the number of runs found.
+        """
+        base, ext = os.path.splitext(self._template_path)
+        indices = []
+        for path in glob.glob(base + '-*' + ext):
+            try:
+                indices.append(int(os.path.splitext(path)[0][len(base) + 1:]))
+            except ValueError:
+                continue
+        return (max(indices) if indices else 0), len(indices)
+
+    def _stale(self, indice, n):
+        """
+        Returns ``True`` if the stored ``indice`` and count ``n`` are known to
+        be out of date, because the result file for ``indice`` is missing.
+        """
+        if indice == 0:
+            return False
+        base, ext = os.path.splitext(self._template_path)
+        return not os.path.exists(base + self._format.format(indice) + ext)
+
+    def count(self):
+        """
+        Returns the number of reserved or finished runs.
+
+        If no counter file exists yet, the directory is scanned without
+        creating one. If the directory does not exist, 0 is returned.
+        """
+        if not os.path.exists(self._path):
+            return self._scan()[1]
+        return self._locked()[1]
+
+    def release(self):
+        """ Decreases the run count by one, after a run has been deleted. """
+        # Don't check the stored values, as the run's files are already gone
+        self._locked(lambda indice, n: (indice, max(0, n - 1)), check=False)
+
+    def reserve(self, reserve, cap=None):
+        """
+        Allocates the next run indice and increases the run count by one.
+
+        The function ``reserve(indice)`` is called while the lock is held, and
+        should return ``True`` if the indice could be claimed (e.g. by creating
+        a file), or ``False`` if the next indice should be tried instead.
+
+        Returns the claimed indice, or ``None`` if ``cap`` is given and the
+        number of runs has already reached it.
+        """
+        claimed = []
+
+        def update(indice, n):
+            if cap is not None and n >= cap:
+                # Rescan before refusing, in case results were deleted
+                indice, n = self._scan()
+                if n >= cap:
+                    return None
+            indice += 1
+            while not reserve(indice):
+                indice += 1
+            claimed.append(indice)
+            return indice, n + 1
+
+        self._locked(update)
+        return claimed[0] if claimed else None
+
+
 class reserve_base_name(object):
     """
     Context manager that reserves a location for storing results, but deletes
@@ -398,9 +2519,17 @@ class reserve_base_name(object):
     A template path is specified by the user, for example
     ``output/result.txt``. Upon entering, this is converted to a numbered path,
     for example ``output/result-i.txt``, such that ``i`` equals one plus the
-    highest indice already found in the same directory. To "reserve" the path,
-    a file is placed at ``output/result-i.txt``, which can be overwritten by
-    the user. Finally, the path to the numbered file is returned.
+    highest indice already handed out for this template. To "reserve" the
+    path, a file is placed at ``output/result-i.txt``, which can be overwritten
+    by the user. Finally, the path to the numbered file is returned.
+
+    Indices are allocated using a :class:`RunCounter`, so that reservations
+    take constant time and are safe when many processes (on one or more
+    machines sharing a file system) reserve at the same time. On platforms
+    without ``fcntl`` the directory is scanned instead.
+
+    If a ``cap`` is given and the number of runs for this template has already
+    reached it, a :class:`CapReached` exception is raised upon entering.
 
     If an exception occurs within the manager's context, the numbered file is
     deleted, **along with any files starting with the same basename as the
@@ -425,9 +2554,15 @@ class reserve_base_name(object):
         A template for the path to store results at: to store results such as
         ``results-1.txt``, ``results-2.txt`` etc., pass in the template
         ``name='results.txt'``.
+    keep_partial
+        Set to ``True`` to keep all files if an exception occurs, for example
+        so that a run can be resumed from a checkpoint.
+    cap
+        An optional maximum number of runs for this template.
 
     """
-    def __init__(self, template_path):
+    def __init__(self, template_path, keep_partial=False, cap=None):
+        self._template_path = template_path
 
         # Split path into directory, basename, and extension
         dirname, basename = os.path.split(template_path)
@@ -439,37 +2574,72 @@ class reserve_base_name(object):
 
         # Indice formatting (must be fixed width and start with hyphen)
         self._format = '-{:03d}'
-        self._nformat = 4
+
+        # Keep files if an exception occurs
+        self._keep_partial = bool(keep_partial)
+
+        # Delete files on exit, even without an exception
+        self._discard = False
+
+        # Maximum number of runs
+        self._cap = None if cap is None else int(cap)
+
+        # Run counter, if file locking is available
+        self._counter = None
+        if fcntl is not None:
+            self._counter = RunCounter(template_path)
+
+    def discard(self):
+        """
+        Marks this reservation so that all its files are deleted when the
+        context is exited, even if no exception occurred.
+        """
+        self._discard = True
+
+    def _claim(self, indice):
+        """
+        Attempts to reserve the file for the given indice, returns ``True`` if
+        successful.
+        """
+        path = self._basename + self._format.format(indice)
+        path = os.path.join(self._dirname, path + self._extension)
+        try:
+            with open(path, 'x') as f:  # Note: Python 3.3+ only
+                f.write('Reserved\n')
+        except FileExistsError:
+            return False
+        return True
 
     def __enter__(self):
 
-        # Find potential indice
-        fs = glob.glob(os.path.join(self._dirname, self._basename + '*'))
-        if fs:
-            i1 = len(self._basename) + 1
-            i2 = i1 + self._nformat - 1
-            fs = [int(os.path.basename(f)[i1:i2]) for f in fs]
-            indice = max(fs)
+        if self._counter is not None:
+            # Allocate indice and make reservation
+            indice = self._counter.reserve(self._claim, self._cap)
+            if indice is None:
+                raise CapReached()
+
         else:
+            # Check cap
+            if self._cap is not None:
+                if count(self._template_path, parse=False) >= self._cap:
+                    raise CapReached()
+
+            # Find potential indice, ignoring any other files that start with
+            # the same base name
             indice = 0
+            pattern = self._basename + '-*' + self._extension
+            for f in glob.glob(os.path.join(self._dirname, pattern)):
+                f = os.path.splitext(os.path.basename(f))[0]
+                try:
+                    indice = max(indice, int(f[len(self._basename) + 1:]))
+                except ValueError:
+                    continue
 
-        # Make reservation
-        running = True
-        while running:
+            # Make reservation
             indice += 1
-            path = self._basename + self._format.format(indice)
-            path = os.path.join(self._dirname, path + self._extension)
-            f = None
-            try:
-                f = open(path, 'x')     # Note: Python 3.3+ only
-                f.write('Reserved\n')
-                running = False
-            except FileExistsError:
+            while not self._claim(indice):
                 # File already exists, try next indice
-                pass
-            finally:
-                if f is not None:
-                    f.close()
+                indice += 1
 
         # Store indice
         self._indice = indice
@@ -482,9 +2652,10 @@ class reserve_base_name(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
 
-        # No exception? Then exit without deleting
-        if exc_type is None:
-            return
+        # No exception, or keeping partial results? Then exit without deleting
+        if not self._discard:
+            if exc_type is None or self._keep_partial:
+                return
 
         # Delete files matching pattern
         pattern = os.path.join(self._dirname, self._basename + '*')
@@ -492,10 +2663,114 @@ class reserve_base_name(object):
             print('Removing unfinished result file: ' + path)
             os.remove(path)
 
+        # Update run count
+        if self._counter is not None:
+            self._counter.release()
+
         # Don't suppress the exception
         return False
 
 
+class EarlyStopper(object):
+    """
+    Predicts whether a running optimisation is unlikely to end with an error
+    within ``threshold`` percent of the best result found so far, based on the
+    logs of the finished runs stored at ``template_path``.
+
+    At iteration ``i``, a run with best score ``f`` is compared to all
+    finished runs whose best score at iteration ``i`` was ``f`` or worse. If
+    the estimated probability that such a run ends within ``threshold``
+    percent of the best result, ``(s + 1) / (n + 2)`` where ``s`` out of ``n``
+    similar runs did, is below ``probability``, the run is deemed hopeless.
+
+    Parameters
+    ----------
+    template_path
+        A template path, e.g. ``output/result.txt``, where results are stored
+        as ``output/result-001.txt`` with logs in
+        ``output/result-001-log.csv``.
+    threshold
+        The maximum relative difference (in percent) with the best result, for
+        a run to count as successful (see ``reliability.ipynb``).
+    probability
+        The probability of success below which a run is stopped.
+    n_parameters
+        The number of parameters in each result.
+    interval
+        The minimum number of seconds between checks for newly finished runs.
+    """
+    def __init__(
+            self, template_path, threshold=2, probability=0.05,
+            n_parameters=9, interval=60):
+        self._template_path = template_path
+        self._n_parameters = int(n_parameters)
+        self._threshold = float(threshold)
+        self._probability = float(probability)
+        self._interval = float(interval)
+        if self._threshold <= 0:
+            raise ValueError('Threshold must be greater than zero.')
+        if not 0 < self._probability < 1:
+            raise ValueError(
+                'Probability must be greater than 0 and less than 1.')
+
+        # Best-so-far trajectories of finished runs, as tuples (iterations,
+        # best, final), by run index
+        self._runs = {}
+
+        # Time of the last refresh
+        self._refreshed = None
+
+    def hopeless(self, iteration, f):
+        """
+        Returns ``True`` if a run with best score ``f`` at the given
+        ``iteration`` is unlikely to reach the threshold.
+
+        The results are refreshed (see :meth:`refresh`) if this hasn't
+        happened in the last ``interval`` seconds.
+        """
+        if (self._refreshed is None
+                or time.time() - self._refreshed >= self._interval):
+            self.refresh()
+        if not self._runs:
+            return False
+
+        # Get best score at this iteration and final score of each run
+        finals = np.array([run[2] for run in self._runs.values()])
+        then = np.array([
+            b[max(0, np.searchsorted(i, iteration, side='right') - 1)]
+            for i, b, final in self._runs.values()])
+
+        # Runs that are already within the threshold always continue
+        best = np.min(finals)
+        target = best * (1 + self._threshold / 100)
+        if f <= target:
+            return False
+
+        # Count runs that were doing as badly, and how many of them succeeded
+        similar = then >= f
+        n = np.count_nonzero(similar)
+        s = np.count_nonzero(finals[similar] <= target)
+        return (s + 1) / (n + 2) < self._probability
+
+    def refresh(self):
+        """ Reads the logs of any newly finished runs. """
+        self._refreshed = time.time()
+        base = os.path.splitext(self._template_path)[0]
+        parameters, info = load(self._template_path, self._n_parameters)
+        for run, final in info[:, :2] if len(info) else []:
+            run = int(run)
+            if run in self._runs:
+                continue
+            try:
+                log = np.loadtxt(
+                    base + '-{:03d}-log.csv'.format(run), delimiter=',',
+                    skiprows=1, usecols=(0, 2), ndmin=2)
+            except (OSError, ValueError):
+                continue
+            if len(log):
+                self._runs[run] = (log[:, 0], log[:, 1], final)
+
+
 def save(path, parameters, error, time, iterations, evaluations):
     """
     Stores a result at the given ``path``.
@@ -533,7 +2808,7 @@ def save(path, parameters, error, time, iterations, evaluations):
     print('Done')
 
 
-def load(template_path, n_parameters=9):
+def load(template_path, n_parameters=9, cache=True):
     """
     Loads and returns all results stored at a given ``template_path``.
 
@@ -542,6 +2817,16 @@ def load(template_path, n_parameters=9):
     template_path
         A template path, e.g. ``output/results.txt``, such that results can be
         found at ``output/results-001.txt``, ``output/results-002.txt``, etc.
+        Alternatively, the path to an existing :class:`ResultStore` file
+        ending in ``.sqlite`` can be given. A ``FileNotFoundError`` is raised
+        if this file does not exist.
+    n_parameters
+        The expected number of parameters in each result file.
+    cache
+        If set to ``True``, parsed results are stored in a hidden cache file
+        next to the results (e.g. ``output/.results.load-cache``), so that
+        subsequent calls only need to parse new or changed files (as detected
+        by their modification time and size).
 
     Returns
     -------
@@ -551,80 +2836,211 @@ def load(template_path, n_parameters=9):
     entry, and each row is structured as ``(run, error, time, iterations,
     evaluations)``. Both arrays are ordered by error (lowest error first).
     """
-    # Split path into directory, base ('results'), and extension ('.txt')
-    dirname, filename = os.path.split(template_path)
-    basename, ext = os.path.splitext(filename)
+    # Load from result store
+    if os.path.splitext(template_path)[1] == '.sqlite':
+        if not os.path.isfile(template_path):
+            raise FileNotFoundError(
+                'Result store not found: ' + str(template_path))
+        with ResultStore(template_path, n_parameters) as store:
+            return store.load()
+
+    # Find and parse results
+    names, rows = _read_results(template_path, n_parameters, cache)
+    if len(rows) == 0:
+        return np.array([]), np.array([])
 
-    # Create pattern to find result files
-    pattern = os.path.join(dirname, basename + '-*.txt')
-    print(basename, pattern)
+    # Sort by error
+    rows = rows[np.argsort(rows[:, 1], kind='stable')]
 
-    # Create empty lists
-    parameters = []
-    info = []
+    return rows[:, 5:], rows[:, :5]
 
-    # Find and process matching files
-    for path in glob.glob(pattern):
 
-        # Get run index from filename
-        filename = os.path.split(path)[1]
-        run = os.path.splitext(filename)[0]
-        try:
-            run = int(run.rsplit('-', 1)[1])
-        except ValueError:
-            print('Unable to parse filename, skipping ' + filename)
-            continue
+def iload(template_path, n_parameters=9, cache=True, follow=False,
+          interval=10, timeout=None):
+    """
+    Generator version of :meth:`load`, that yields results one at a time, as
+    tuples ``(parameters, info)`` where ``parameters`` is a numpy array of
+    length ``n_parameters`` and ``info`` is a numpy array ``(run, error, time,
+    iterations, evaluations)``.
 
-        # Naively parse file, warn and skip unparseable files
-        error = time = iters = evals = params = None
-        try:
-            todo = 5
-            with open(path, 'r') as f:
-                for i in range(100):    # Give up after 100 lines
-                    line = f.readline().strip()
-                    if line.startswith('error:'):
-                        error = float(line[6:])
-                        todo -= 1
-                    elif line.startswith('time:'):
-                        time = float(line[5:])
-                        todo -= 1
-                    elif line.startswith('iterations:'):
-                        iters = int(line[11:])
-                        todo -= 1
-                    elif line.startswith('evaluations:'):
-                        evals = int(line[12:])
-                        todo -= 1
-                    elif line == 'parameters:':
-                        params = [
-                            float(f.readline()) for j in range(n_parameters)]
-                        todo -= 1
-                    if todo == 0:
-                        break
-                if todo:
-                    print('Unable to find all information, skipping '
-                          + filename)
-                    continue
+    Parameters
+    ----------
+    template_path
+        A template path, e.g. ``output/results.txt``.
+    n_parameters
+        The expected number of parameters in each result file.
+    cache
+        Set to ``True`` to use a cache of parsed results, see :meth:`load`.
+    follow
+        If set to ``True``, the directory is checked for new results every
+        ``interval`` seconds after all current results have been yielded, so
+        that a fitting study can be monitored while it is still running.
+    interval
+        The number of seconds to wait between checks, if ``follow=True``.
+    timeout
+        If ``follow=True``, the generator stops once no new results have
+        appeared for ``timeout`` seconds. If set to ``None`` it continues
+        until the caller stops iterating.
 
-        except Exception as e:
-            print('Error when parsing file, skipping ' + filename)
-            print(e)
-            continue
+    Example::
 
-        # Store
-        parameters.append(params)
-        info.append(np.array([run, error, time, iters, evals]))
+        for parameters, info in iload('output/result.txt', follow=True):
+            print('Run ' + str(int(info[0])) + ' finished: ' + str(info[1]))
 
-    # Convert to arrays
-    parameters = np.array(parameters)
-    info = np.array(info)
+    """
+    seen = {}
+    last = time.time()
+    while True:
+        names, rows = _read_results(template_path, n_parameters, cache)
+        for name, row in zip(names, rows):
+            if name not in seen or not np.array_equal(seen[name], row):
+                seen[name] = row
+                last = time.time()
+                yield row[5:], row[:5]
+
+        if not follow:
+            return
+        if timeout is not None and time.time() - last > timeout:
+            return
+        time.sleep(interval)
 
-    # Sort by error
-    if len(parameters) > 0:
-        order = np.argsort(info[:, 1])
-        parameters = parameters[order]
-        info = info[order]
 
-    return parameters, info
+def _read_results(template_path, n_parameters, cache):
+    """
+    Finds and parses all result files matching ``template_path``, and returns
+    a tuple ``(names, rows)`` where ``names`` is a list of file names and
+    ``rows`` is an array with one row ``(run, error, time, iterations,
+    evaluations, p1, p2, ...)`` per file.
+
+    If ``cache`` is ``True``, parsed results are read from and stored in a
+    cache file, keyed on each file's name, modification time, and size.
+    """
+    # Split path into directory, base ('results'), and extension ('.txt')
+    dirname, filename = os.path.split(template_path)
+    basename, ext = os.path.splitext(filename)
+    prefix = basename + '-'
+    width = 5 + n_parameters
+
+    # Load cached results, for the same number of parameters. The cache is
+    # stored as arrays, as these are much faster to unpickle than tuples.
+    cache_path = os.path.join(dirname, '.' + basename + '.load-cache')
+    c_names, c_keys, c_rows = [], np.zeros((0, 2)), np.zeros((0, width))
+    if cache:
+        try:
+            with open(cache_path, 'rb') as f:
+                n, names, keys, rows = pickle.load(f)
+            if n == n_parameters:
+                c_names, c_keys, c_rows = names, keys, rows
+        except Exception:
+            pass
+    c_index = {name: i for i, name in enumerate(c_names)}
+    c_keys = [tuple(key) for key in c_keys.tolist()]
+
+    # Find and process matching files, or return nothing if the directory
+    # doesn't exist
+    names, keys, hits, new_names, new_keys, new_rows = [], [], [], [], [], []
+    try:
+        it = os.scandir(dirname or '.')
+    except FileNotFoundError:
+        return [], np.zeros((0, width))
+    with it:
+        for entry in it:
+            filename = entry.name
+            if not (filename.startswith(prefix) and filename.endswith('.txt')):
+                continue
+
+            # Get run index from filename
+            try:
+                run = int(filename[:-4].rsplit('-', 1)[1])
+            except ValueError:
+                print('Unable to parse filename, skipping ' + filename)
+                continue
+
+            # Use cached result if file hasn't changed, or parse
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            key = (stat.st_mtime_ns, stat.st_size)
+            i = c_index.get(filename)
+            if i is not None and c_keys[i] == key:
+                names.append(filename)
+                keys.append(key)
+                hits.append(i)
+            else:
+                row = _parse_result(entry.path, run, n_parameters)
+                new_names.append(filename)
+                new_keys.append(key)
+                # Unparseable files are cached as a row of NaNs
+                new_rows.append([np.nan] * width if row is None else row)
+
+    # Combine cached and newly parsed results
+    names += new_names
+    keys = np.array(keys + new_keys, dtype=np.int64).reshape((-1, 2))
+    rows = np.concatenate((
+        c_rows[hits], np.array(new_rows, dtype=float).reshape((-1, width))))
+
+    # Update cache, ignoring failures (e.g. in read-only directories)
+    if cache and (new_names or len(names) != len(c_names)):
+        try:
+            temp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_path, 'wb') as f:
+                pickle.dump((n_parameters, names, keys, rows), f)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+
+    # Return parseable results only
+    valid = np.isfinite(rows[:, 0])
+    return [name for name, v in zip(names, valid) if v], rows[valid]
+
+
+def _parse_result(path, run, n_parameters):
+    """
+    Parses a single result file, and returns a tuple ``(run, error, time,
+    iterations, evaluations, p1, p2, ...)``, or ``None`` if the file could not
+    be parsed.
+    """
+    filename = os.path.split(path)[1]
+
+    # Naively parse file, warn and skip unparseable files
+    error = time = iters = evals = params = None
+    try:
+        todo = 5
+        with open(path, 'r') as f:
+            for i in range(100):    # Give up after 100 lines
+                line = f.readline().strip()
+                if i == 0 and line == 'Reserved':
+                    return None     # Placeholder for a run in progress
+                if line.startswith('error:'):
+                    error = float(line[6:])
+                    todo -= 1
+                elif line.startswith('time:'):
+                    time = float(line[5:])
+                    todo -= 1
+                elif line.startswith('iterations:'):
+                    iters = int(line[11:])
+                    todo -= 1
+                elif line.startswith('evaluations:'):
+                    evals = int(line[12:])
+                    todo -= 1
+                elif line == 'parameters:':
+                    params = [
+                        float(f.readline()) for j in range(n_parameters)]
+                    todo -= 1
+                if todo == 0:
+                    break
+            if todo:
+                print('Unable to find all information, skipping '
+                      + filename)
+                return None
+
+    except Exception as e:
+        print('Error when parsing file, skipping ' + filename)
+        print(e)
+        return None
+
+    return tuple([run, error, time, iters, evals] + params)
 
 
 def count(template_path, n_parameters=9, parse=True):
@@ -643,13 +3059,19 @@ def count(template_path, n_parameters=9, parse=True):
         If set to ``True``, this method will read all files matching the
         template, and so count the number of valid, parseable files. If set to
         false any files matching the template will be counted, regardless of
-        their content.
+        their content. If a :class:`RunCounter` is available this is read
+        instead of scanning the directory, so that the number of reserved or
+        finished runs is returned in constant time.
     """
     # Load and count all files
     if parse:
         parameters, info = load(template_path, n_parameters)
         return len(parameters)
 
+    # Read run counter
+    if fcntl is not None:
+        return RunCounter(template_path).count()
+
     # Scan for files matching the template
     n = 0
     base, ext = os.path.splitext(template_path)
@@ -669,7 +3091,118 @@ def count(template_path, n_parameters=9, parse=True):
     return n
 
 
-def fit(name, error, boundaries, transformation=None, repeats=1, cap=None):
+class ResultStore(object):
+    """
+    Stores fitting results in a single SQLite database file.
+
+    Each result is stored as a row ``(run, error, time, iterations,
+    evaluations, p1, p2, ...)``, with an index on the error so that results
+    can be read back in order (from best to worst) in a single query. Results
+    are appended in a transaction, so that many processes can add results to
+    the same store at once (note that SQLite's locking may be unreliable on
+    some network file systems).
+
+    Example::
+
+        # Import existing results
+        with ResultStore('method-2.sqlite') as store:
+            store.import_results('four-ways/method-2/cell-1-fit-2-run.txt')
+            parameters, info = store.load()
+
+    Parameters
+    ----------
+    path
+        The path to the database file (typically ending in ``.sqlite``). A new
+        store is created if the file doesn't exist.
+    n_parameters
+        The number of parameters in each result.
+    timeout
+        The maximum time (in seconds) to wait if the store is locked by
+        another process.
+    """
+    def __init__(self, path, n_parameters=9, timeout=60):
+        self._path = path
+        self._n_parameters = int(n_parameters)
+        self._columns = ['p' + str(1 + i) for i in range(self._n_parameters)]
+
+        self._db = sqlite3.connect(path, timeout=timeout)
+        with self._db:
+            self._db.execute(
+                'create table if not exists results (run integer primary key,'
+                ' error real, time real, iterations integer,'
+                ' evaluations integer, '
+                + ', '.join(c + ' real' for c in self._columns) + ')')
+            self._db.execute(
+                'create index if not exists results_error on results (error)')
+
+        # Check number of parameters
+        columns = self._db.execute('pragma table_info(results)').fetchall()
+        if len(columns) != 5 + self._n_parameters:
+            self.close()
+            raise ValueError(
+                'Store at ' + str(path) + ' contains results with '
+                + str(len(columns) - 5) + ' parameters, expected '
+                + str(self._n_parameters) + '.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute('select count(*) from results').fetchone()[0]
+
+    def append(self, run, parameters, error, time, iterations, evaluations):
+        """
+        Adds a result to this store, replacing any existing result with the
+        same ``run`` index. For the arguments, see :meth:`save`.
+        """
+        parameters = [float(p) for p in parameters]
+        if len(parameters) != self._n_parameters:
+            raise ValueError(
+                'Expecting ' + str(self._n_parameters) + ' parameters.')
+        row = [int(run), float(error), float(time), int(iterations),
+               int(evaluations)] + parameters
+        with self._db:
+            self._db.execute(
+                'insert or replace into results values ('
+                + ', '.join(['?'] * len(row)) + ')', row)
+
+    def close(self):
+        """ Closes the connection to the database file. """
+        self._db.close()
+
+    def import_results(self, template_path):
+        """
+        Imports all text-file results stored at ``template_path`` (see
+        :meth:`load`), and returns the number of results imported.
+        """
+        parameters, info = load(template_path, self._n_parameters)
+        rows = [[int(i[0]), i[1], i[2], int(i[3]), int(i[4])] + list(p)
+                for p, i in zip(parameters, info)]
+        with self._db:
+            self._db.executemany(
+                'insert or replace into results values ('
+                + ', '.join(['?'] * (5 + self._n_parameters)) + ')', rows)
+        return len(rows)
+
+    def load(self):
+        """
+        Returns all results in this store, in the format used by :meth:`load`.
+        """
+        rows = np.array(self._db.execute(
+            'select * from results order by error').fetchall(), dtype=float)
+        if len(rows) == 0:
+            return np.array([]), np.array([])
+        return rows[:, 5:], rows[:, :5]
+
+
+def fit(name, error, boundaries, transformation=None, repeats=1, cap=None,
+        processes=1, parallel=True, pool=None, checkpoint=None, resume=False,
+        store=None, warm_start=None, warm_start_covariance=False,
+        early_stop=None, early_stop_probability=0.05, max_iterations=None,
+        profile=False):
     """
     Minimises the given ``error``, and stores the results in the directory
     ``name``.
@@ -685,7 +3218,11 @@ def fit(name, error, boundaries, transformation=None, repeats=1, cap=None):
         The directory to store results in (a string).
     error
         A ``pints.ErrorMeasure`` to minimise (or a ``pints.LogLikelihood`` to
-        maximise).
+        maximise). If the error has an ``evaluate_batch`` method (see
+        :class:`MeanSquaredError`), each CMA-ES population is evaluated with a
+        single call to this method, unless it is a :class:`MeanSquaredError`
+        or :class:`MultiResolutionError` whose model can only simulate one
+        parameter vector at a time: these are evaluated in parallel instead.
     boundaries
         A boundaries object, used to constrain the search and to sample initial
         starting points.
@@ -696,6 +3233,72 @@ def fit(name, error, boundaries, transformation=None, repeats=1, cap=None):
     cap
         The maximum number of results to obtain in the given directory (default
         is ``None``, for unlimited).
+    processes
+        The number of optimisations to run at the same time, each in its own
+        process (default is 1). Each process keeps claiming repeats until all
+        ``repeats`` have been run or the ``cap`` is reached.
+    parallel
+        Parallelisation within each optimisation. Set to ``False`` to evaluate
+        the points in each population sequentially, or set to an integer to
+        use that number of worker processes per optimisation. The default,
+        ``True``, divides all available cores between the ``processes``. The
+        number of workers is limited to the CMA-ES population size. Each
+        process creates a single :class:`WorkerPool`, which is reused for all
+        its repeats. This setting is ignored for errors that evaluate a whole
+        population at once (see ``error``), or if a ``pool`` is given.
+    pool
+        An optional :class:`WorkerPool` to evaluate all populations with. The
+        pool will not be closed after fitting, so it can be reused. A pool
+        cannot be combined with ``processes > 1``.
+    checkpoint
+        An optional number of iterations between checkpoints. If set, the state
+        of each optimisation is stored in a file ``result-i-checkpoint.pickle``
+        every ``checkpoint`` iterations, and unfinished runs are no longer
+        deleted when an error occurs, if a checkpoint has been written (runs
+        that fail before their first checkpoint are still deleted). Checkpoint
+        files are removed once a run has finished.
+    resume
+        Set to ``True`` to resume any unfinished (checkpointed) runs in
+        ``name`` before starting new ones. Each resumed run counts as one of
+        the ``repeats``. This should only be used when no other fits are
+        running in the same directory.
+    store
+        An optional path to a :class:`ResultStore` file. If given, every
+        result is added to this store, in addition to being saved as a text
+        file.
+    warm_start
+        An optional array of parameter sets (with shape ``(n, n_parameters)``)
+        to start from instead of sampling from the ``boundaries``, for example
+        the best results of a previous fit, as returned by :meth:`load`. Each
+        run starts from the next parameter set in turn (skipping any for which
+        the error can't be calculated).
+    warm_start_covariance
+        If set to ``True``, every run instead starts with a CMA-ES population
+        centered on the mean of the ``warm_start`` parameter sets, and with
+        their covariance (both calculated in the search space).
+    early_stop
+        An optional threshold (in percent, e.g. ``2``). If set, an
+        :class:`EarlyStopper` checks every 20 iterations whether a run is
+        likely to end within this percentage of the best result obtained so
+        far, based on the logs of the finished runs in ``name`` (which are
+        checked for new results at most once a minute). Runs that are
+        unlikely to do so are stopped and deleted, and replaced by a fresh
+        start (which is never stopped early). Resumed runs are never stopped
+        early either. Early stopping can not be used with a log pdf.
+    early_stop_probability
+        The estimated probability of success below which runs are stopped.
+    max_iterations
+        An optional maximum number of iterations per run, e.g. for short test
+        or benchmark runs.
+    profile
+        Set to ``True`` to profile each run with a :class:`Profiler`, and
+        store the profile as ``result-i-profile.json``. This records the time
+        spent choosing a starting point, in each step of the optimisation
+        loop, transforming parameters, calculating errors, and simulating
+        (including the time spent in any :class:`WorkerPool` workers), and
+        counts the evaluations, failed simulations, non-finite errors, and
+        points rejected by the boundaries. For resumed runs, only the time
+        since resuming is profiled.
 
     """
     debug = False
@@ -718,63 +3321,80 @@ def fit(name, error, boundaries, transformation=None, repeats=1, cap=None):
             raise ValueError(
                 'Cap on total number of runs must be at least 1 (or None).')
 
-    # Run
-    for i in range(repeats):
+    # Check the number of processes
+    processes = int(processes)
+    if processes < 1:
+        raise ValueError('Number of processes must be at least 1.')
+    processes = min(processes, repeats)
+    if pool is not None and processes > 1:
+        raise ValueError('A worker pool cannot be used with processes > 1.')
+
+    # Check the checkpoint interval
+    if checkpoint is not None:
+        checkpoint = int(checkpoint)
+        if checkpoint < 1:
+            raise ValueError(
+                'Number of iterations between checkpoints must be at least 1'
+                ' (or None).')
 
-        # Cap the maximum number of runs
-        cap_info = ''
-        if cap:
-            n = count(template_path, n_parameters=n_parameters, parse=False)
-            if n >= cap:
-                print()
-                print('Maximum number of runs reached: terminating.')
-                print()
-                return
-            cap_info = ' (run ' + str(n + 1) + ', capped at ' + str(cap) + ')'
-
-        # Show configuration
-        print()
-        print('Repeat ' + str(1 + i) + ' of ' + str(repeats) + cap_info)
-        print()
-
-        # Get base filename to store results in
-        with reserve_base_name(template_path) as path:
-            print('Storing results in ' + path)
-
-            # Choose starting point
-            # Allow resampling, in case error calculation fails
-            print('Choosing starting point')
-            p0 = s0 = float('inf')
-            while not np.isfinite(s0):
-                p0 = boundaries.sample(1)[0]
-                s0 = error(p0)
-
-            # Create a file path to store the optimisation log in
-            log_path = os.path.splitext(path)
-            log_path = log_path[0] + '-log.csv'
-
-            # Create optimiser
-            opt = pints.OptimisationController(
-                error,
-                p0,
-                boundaries=boundaries,
-                transformation=transformation,
-                method=pints.CMAES,
-            )
-            opt.set_log_to_file(log_path, csv=True)
-            opt.set_max_iterations(3 if debug else None)
-            opt.set_parallel(True)
+    # Check the warm start parameters
+    if warm_start is not None:
+        warm_start = np.array(warm_start, dtype=float, ndmin=2)
+        if warm_start.shape[1:] != (n_parameters, ) or len(warm_start) < 1:
+            raise ValueError(
+                'Warm start must be an array of shape (n, n_parameters).')
+        if warm_start_covariance and len(warm_start) < 2:
+            raise ValueError(
+                'At least two warm start points are needed to estimate a'
+                ' covariance.')
+    elif warm_start_covariance:
+        raise ValueError('A covariance can only be used with a warm start.')
+
+    # Create early stopper
+    stopper = None
+    if early_stop is not None:
+        if isinstance(error, pints.LogPDF):
+            raise ValueError(
+                'Early stopping can only be used when minimising an error.')
+        stopper = EarlyStopper(
+            template_path, early_stop, early_stop_probability, n_parameters)
+
+    # Find unfinished runs to resume
+    resumes = _find_unfinished(template_path) if resume else []
+    resumes = resumes[:repeats]
+    if resumes:
+        print('Found ' + str(len(resumes)) + ' unfinished run(s) to resume.')
+
+    # Set parallelisation within each optimisation, using no more workers
+    # than the CMA-ES default population size (as a ParallelEvaluator would)
+    if parallel is True:
+        parallel = max(1, pints.ParallelEvaluator.cpu_count() // processes)
+    elif parallel is not False:
+        parallel = int(parallel)
+        if parallel < 1:
+            raise ValueError(
+                'Number of workers per optimisation must be at least 1.')
+    if parallel is not False:
+        parallel = min(parallel, 4 + int(3 * np.log(error.n_parameters())))
 
-            # Run optimisation
-            print('Running')
-            with np.errstate(all='ignore'): # Ignore numpy warnings
-                p, s = opt.run()
+    # Create object to run repeats with
+    fitter = _Fitter(
+        template_path, error, boundaries, transformation, repeats, cap,
+        parallel, 3 if debug else max_iterations, checkpoint, resumes, store,
+        warm_start, warm_start_covariance, stopper, profile)
 
-            # Store results for this run
-            time = opt.time()
-            iters = opt.iterations()
-            evals = opt.evaluations()
-            save(path, p, s, time, iters, evals)
+    # Run
+    if processes == 1:
+        fitter.work(pool=pool)
+
+    else:
+        # Run multiple optimisations at once, with each process claiming the
+        # next repeat from a shared counter. Each process is given its own
+        # seed, so that they don't all sample the same starting points.
+        next_repeat = multiprocessing.Value('i', 0)
+        seeds = np.random.randint(0, 2**31, processes)
+        _run_processes(
+            fitter.work, [(seed, next_repeat) for seed in seeds])
 
     # Show best results
     parameters, info = load(template_path, n_parameters)
@@ -785,3 +3405,790 @@ def fit(name, error, boundaries, transformation=None, repeats=1, cap=None):
         print('Mean: ' + str(np.mean(info[:, 1])))
         print('Std : ' + str(np.std(info[:, 1])))
 
+
+def fit_cells(name, data_dir, create_error, pattern='cell-*.zip', g_min=0.1,
+              log_transform=True, repeats=1, cap=None, processes=None,
+              checkpoint=None):
+    """
+    Fits to every recording in ``data_dir`` matching ``pattern``, running all
+    cell and repeat combinations as a single batch of jobs, spread out over
+    ``processes`` processes.
+
+    For each recording (e.g. ``cell-1.zip``), the data is loaded with
+    :meth:`load_log`, and an error is created by calling
+    ``create_error(log)``. Results are stored in a subdirectory of ``name``
+    for each cell (e.g. ``name/cell-1/result-i.txt``), and in a
+    :class:`ResultStore` for each cell (e.g. ``name/cell-1/store.sqlite``).
+
+    Each process runs one optimisation at a time, evaluating points
+    sequentially, and claims the next job as soon as it finishes. Jobs are
+    ordered by repeat, so that all cells progress at the same rate.
+
+    Parameters
+    ----------
+    name
+        The directory to store results in (a string).
+    data_dir
+        The directory containing the recordings.
+    create_error
+        A function ``create_error(log)`` that returns a ``pints.ErrorMeasure``
+        for a :class:`myokit.DataLog`.
+    pattern
+        A glob pattern to select recordings in ``data_dir``.
+    g_min
+        The lower bound on the conductance for each cell's
+        :class:`Boundaries`. This can be a number, or a dict mapping cell names
+        (e.g. ``cell-1``) to numbers.
+    log_transform
+        Set to ``True`` to search in the transformed space given by
+        :meth:`transformation`.
+    repeats
+        The maximum number of optimisations to run per cell.
+    cap
+        The maximum number of results to obtain per cell.
+    processes
+        The number of processes to use, or ``None`` to use all available
+        cores.
+    checkpoint
+        An optional number of iterations between checkpoints, see :meth:`fit`.
+
+    """
+    # Find recordings
+    paths = sorted(glob.glob(os.path.join(data_dir, pattern)))
+    if not paths:
+        raise ValueError(
+            'No recordings matching ' + pattern + ' found in ' + data_dir)
+
+    # Check the number of repeats, processes, and checkpoint interval
+    repeats = int(repeats)
+    if repeats < 1:
+        raise ValueError('Number of repeats must be at least 1.')
+    if cap is not None:
+        cap = int(cap)
+        if cap < 1:
+            raise ValueError(
+                'Cap on total number of runs must be at least 1 (or None).')
+    if processes is None:
+        processes = pints.ParallelEvaluator.cpu_count()
+    processes = int(processes)
+    if processes < 1:
+        raise ValueError('Number of processes must be at least 1.')
+    if checkpoint is not None:
+        checkpoint = int(checkpoint)
+        if checkpoint < 1:
+            raise ValueError(
+                'Number of iterations between checkpoints must be at least 1'
+                ' (or None).')
+
+    # Create a fitter for each cell
+    fitters = collections.OrderedDict()
+    for path in paths:
+        cell = os.path.splitext(os.path.basename(path))[0]
+        print('Loading ' + cell)
+        error = create_error(load_log(path))
+        g = g_min[cell] if isinstance(g_min, dict) else g_min
+        cell_dir = os.path.join(name, cell)
+        os.makedirs(cell_dir, exist_ok=True)
+        fitters[cell] = _Fitter(
+            os.path.join(cell_dir, 'result.txt'), error, Boundaries(g_min=g),
+            transformation() if log_transform else None, repeats, cap, False,
+            None, checkpoint, [], os.path.join(cell_dir, 'store.sqlite'))
+
+    # Create jobs, ordered by repeat
+    jobs = [(cell, i) for i in range(repeats) for cell in fitters]
+
+    # Run
+    processes = min(processes, len(jobs))
+    if processes == 1:
+        _fit_cells_worker(fitters, jobs)
+    else:
+        next_job = multiprocessing.Value('i', 0)
+        seeds = np.random.randint(0, 2**31, processes)
+        _run_processes(
+            _fit_cells_worker, [(fitters, jobs, next_job, s) for s in seeds])
+
+    # Show best results
+    print()
+    for cell, fitter in fitters.items():
+        parameters = []
+        if os.path.isfile(fitter.store):
+            parameters, info = load(fitter.store)
+        if len(parameters) > 0:
+            print(cell + ': ' + str(len(parameters)) + ' results, best score '
+                  + str(info[0, 1]))
+        else:
+            print(cell + ': no results')
+
+
+def _fit_cells_worker(fitters, jobs, next_job=None, seed=None):
+    """
+    Runs the ``(cell, repeat)`` jobs for :meth:`fit_cells`, claiming job
+    indices from the shared ``next_job`` counter, or running all jobs if no
+    counter is given.
+    """
+    if seed is not None:
+        np.random.seed(seed)
+
+    capped = set()
+    j = 0
+    while True:
+        if next_job is not None:
+            with next_job.get_lock():
+                j = next_job.value
+                next_job.value += 1
+        if j >= len(jobs):
+            return
+        cell, i = jobs[j]
+        if cell not in capped:
+            print()
+            print('Cell ' + cell)
+            if not fitters[cell].repeat(i, None):
+                capped.add(cell)
+        j += 1
+
+
+def _run_processes(target, args, timeout=10):
+    """
+    Runs ``target(*a)`` for every tuple ``a`` in ``args``, each in its own
+    process, and waits for all processes to finish.
+
+    If the parent process is interrupted, or another error occurs while
+    waiting, the children are stopped with ``SIGTERM``. This raises a
+    ``KeyboardInterrupt`` in each child (see :meth:`_child_process`), so that
+    unfinished runs are cleaned up as they would be in a single process.
+    Children still running after ``timeout`` seconds are killed.
+    """
+    workers = [
+        multiprocessing.Process(
+            target=_child_process, args=(target, ) + tuple(a))
+        for a in args]
+    try:
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    except BaseException:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        for w in workers:
+            if w.pid is not None:
+                w.join(timeout)
+                if w.is_alive():
+                    w.kill()
+        raise
+    failed = [w for w in workers if w.exitcode != 0]
+    if failed:
+        raise RuntimeError(
+            str(len(failed)) + ' optimisation process(es) failed.')
+
+
+def _child_process(target, *args):
+    """
+    Runs ``target(*args)`` in a process started by :meth:`_run_processes`.
+
+    Interrupts are left to the parent process, which forwards them as a
+    ``SIGTERM``, so that each child is stopped exactly once, whether the
+    interrupt was sent to the whole process group (e.g. Ctrl-C in a terminal)
+    or to the parent only (e.g. by Jupyter).
+    """
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        target(*args)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+class _Fitter(object):
+    """
+    Runs the repeated optimisations for :meth:`fit`, using the (checked)
+    settings passed in to :meth:`fit`.
+
+    The first ``len(resumes)`` repeats resume the unfinished runs stored at
+    the paths in ``resumes``.
+    """
+    def __init__(self, template_path, error, boundaries, transformation,
+                 repeats, cap, parallel, max_iterations, checkpoint, resumes,
+                 store, warm_start=None, warm_start_covariance=False,
+                 stopper=None, profile=False):
+        self.template_path = template_path
+        self.error = error
+        self.boundaries = boundaries
+        self.transformation = transformation
+        self.repeats = repeats
+        self.cap = cap
+        self.parallel = parallel
+        self.max_iterations = max_iterations
+        self.checkpoint = checkpoint
+        self.resumes = resumes
+        self.store = store
+        self.warm_start = warm_start
+        self.stopper = stopper
+        self.profile = profile
+
+        # Calculate mean and covariance of warm start, in the search space
+        self.warm_start_covariance = None
+        if warm_start_covariance:
+            x = warm_start
+            if transformation is not None:
+                x = np.array([transformation.to_search(p) for p in x])
+            mean = np.mean(x, axis=0)
+            cov = np.atleast_2d(np.cov(x, rowvar=False))
+
+            # Regularise, in case there are fewer points than parameters
+            cov += np.eye(len(mean)) * 1e-6 * np.trace(cov) / len(mean)
+            if transformation is not None:
+                mean = transformation.to_model(mean)
+            if not boundaries.check(mean):
+                raise ValueError(
+                    'The mean of the warm start points lies outside the'
+                    ' boundaries.')
+            self.warm_start_covariance = (mean, cov)
+
+    def work(self, seed=None, next_repeat=None, pool=None):
+        """
+        Runs repeats, claiming repeat indices from the shared ``next_repeat``
+        counter until none are left or the cap is reached.
+
+        If ``next_repeat`` is ``None`` all repeats are run in this process. If
+        no ``pool`` is given, but parallel evaluation is requested, a pool is
+        created and used for all repeats.
+        """
+        if seed is not None:
+            np.random.seed(seed)
+
+        # Create a pool, in which each worker gets its own copy of the error
+        own_pool = False
+        if (pool is None and self.parallel
+                and not _has_batch(self.error)):
+            pool = WorkerPool(copy.copy, (self.error, ), self.parallel)
+            own_pool = True
+
+        try:
+            i = 0
+            while True:
+                if next_repeat is not None:
+                    with next_repeat.get_lock():
+                        i = next_repeat.value
+                        next_repeat.value += 1
+                if i >= self.repeats or not self.repeat(i, pool):
+                    return
+                i += 1
+        finally:
+            if own_pool:
+                pool.close()
+
+    def repeat(self, i, pool):
+        """
+        Runs and stores a single optimisation, or returns ``False`` if the cap
+        on the number of results was reached.
+        """
+        # Resume an unfinished run
+        if i < len(self.resumes):
+            print()
+            print('Repeat ' + str(1 + i) + ' of ' + str(self.repeats)
+                  + ' (resuming ' + self.resumes[i] + ')')
+            print()
+            self.run(self.resumes[i], pool, resume=True)
+            return True
+
+        # Get base filename to store results in, and cap the maximum number of
+        # runs. Both happen in a single reservation, so that concurrent
+        # processes can't exceed the cap. Runs that are stopped early are
+        # discarded, and replaced by a new run. This new run is never stopped
+        # early, so that each repeat is restarted at most once.
+        keep = self.checkpoint is not None
+        finished = False
+        first = True
+        while not finished:
+            reservation = reserve_base_name(
+                self.template_path, keep_partial=keep, cap=self.cap)
+            try:
+                with reservation as path:
+
+                    # Show configuration
+                    cap_info = ''
+                    if self.cap:
+                        cap_info = ' (capped at ' + str(self.cap) + ')'
+                    print()
+                    print('Repeat ' + str(1 + i) + ' of ' + str(self.repeats)
+                          + cap_info)
+                    print()
+
+                    print('Storing results in ' + path)
+                    try:
+                        finished = self.run(path, pool, stop_early=first)
+                    except BaseException:
+                        # Only keep partial results that can be resumed
+                        checkpoint_path = (
+                            os.path.splitext(path)[0] + '-checkpoint.pickle')
+                        if not os.path.exists(checkpoint_path):
+                            reservation.discard()
+                        raise
+                    first = False
+                    if not finished:
+                        print('Stopped early: discarding run')
+                        reservation.discard()
+            except CapReached:
+                print()
+                print('Maximum number of runs reached: terminating.')
+                print()
+                return False
+
+        return True
+
+    def run(self, path, pool, resume=False, stop_early=False):
+        """
+        Runs a single optimisation, and stores the result at ``path``.
+
+        If ``stop_early`` is ``True`` and an early stopper was set, this
+        returns ``False`` if the run was stopped early, in which case no
+        results are stored.
+        """
+        # Create file paths to store the optimisation log and checkpoints in
+        base = os.path.splitext(path)[0]
+        log_path = base + '-log.csv'
+        checkpoint_path = base + '-checkpoint.pickle'
+        run = int(base.rsplit('-', 1)[1])
+
+        # Check for hopeless runs
+        stopped = []
+
+        def hopeless(iteration, f):
+            if self.stopper.hopeless(iteration, f):
+                stopped.append(iteration)
+                return True
+            return False
+
+        stop = None
+        if self.stopper is not None and stop_early:
+            stop = hopeless
+
+        # Choose a starting point and run, with profiling if enabled
+        profiler = Profiler() if self.profile else None
+        with profiler if profiler else contextlib.nullcontext():
+            p0 = covariance = None
+            if not resume:
+                print('Choosing starting point')
+                p0, covariance = self.start(run, pool)
+
+            # Run optimisation
+            print('Running')
+            with np.errstate(all='ignore'):     # Ignore numpy warnings
+                p, s, time, iters, evals = _optimise(
+                    self.error, p0, self.boundaries, self.transformation,
+                    log_path, pool=pool, max_iterations=self.max_iterations,
+                    checkpoint=self.checkpoint,
+                    checkpoint_path=checkpoint_path, resume=resume,
+                    covariance=covariance, stop=stop)
+        if stopped:
+            return False
+
+        # Store results for this run, and remove checkpoint
+        save(path, p, s, time, iters, evals)
+        if self.store is not None:
+            with ResultStore(self.store, len(p)) as store:
+                store.append(run, p, s, time, iters, evals)
+        if profiler is not None:
+            profiler.save(base + '-profile.json')
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return True
+
+    @_profiled('start')
+    def start(self, run, pool):
+        """
+        Chooses a starting point for the run with index ``run``, and returns
+        a tuple ``(p0, covariance)`` where ``covariance`` is ``None`` unless
+        the initial CMA-ES covariance is set by a warm start.
+
+        Candidate starting points are checked in batches, and the first one
+        with a finite error is returned.
+        """
+        # Start from the mean and covariance of the warm start points
+        if self.warm_start_covariance is not None:
+            return self.warm_start_covariance
+
+        # Evaluate in batches of the CMA-ES default population size if a
+        # batch method or pool is available, or one at a time otherwise
+        n = 1
+        if _has_batch(self.error):
+            evaluate = self.error.evaluate_batch
+            n = 4 + int(3 * np.log(self.error.n_parameters()))
+        elif pool is not None:
+            evaluate = pool.evaluate_batch
+            n = pool.n_workers()
+        else:
+            def evaluate(ps):
+                return [self.error(p) for p in ps]
+
+        # Try warm start points, starting at a different point for each run
+        if self.warm_start is not None:
+            m = len(self.warm_start)
+            order = (run - 1 + np.arange(m)) % m
+            for i in range(0, m, n):
+                ps = self.warm_start[order[i:i + n]]
+                ps = ps[[self.boundaries.check(p) for p in ps]]
+                if len(ps) == 0:
+                    continue
+                fs = np.asarray(evaluate(ps))
+                ok = np.nonzero(np.isfinite(fs))[0]
+                if len(ok):
+                    return ps[ok[0]], None
+            print('No valid warm start points, sampling instead')
+
+        # Sample starting points, in case error calculation fails
+        while True:
+            ps = self.boundaries.sample(n)
+            fs = np.asarray(evaluate(ps))
+            ok = np.nonzero(np.isfinite(fs))[0]
+            if len(ok):
+                return ps[ok[0]], None
+
+
+def _find_unfinished(template_path):
+    """
+    Returns a sorted list of paths to unfinished results, for which a
+    checkpoint is available.
+    """
+    base, ext = os.path.splitext(template_path)
+    paths = []
+    for path in glob.glob(base + '-*-checkpoint.pickle'):
+        path = path[:-len('-checkpoint.pickle')] + ext
+        try:
+            with open(path, 'r') as f:
+                if f.read().strip() == 'Reserved':
+                    paths.append(path)
+        except IOError:
+            pass
+    return sorted(paths)
+
+
+class _CMAESInternals(object):
+    """
+    Access to the private parts of :class:`pints.CMAES` and
+    :class:`pints.Logger` used by :meth:`_optimise`, for which PINTS has no
+    public methods.
+
+    All private access is kept here, so that changes in PINTS only affect
+    these methods. If an attribute is no longer available, a
+    ``RuntimeError`` is raised that names the unsupported feature.
+    """
+    @staticmethod
+    @contextlib.contextmanager
+    def _guard(feature):
+        try:
+            yield
+        except AttributeError as e:
+            raise RuntimeError(
+                'Unable to ' + feature + ' with PINTS ' + pints.__version__
+                + ': ' + str(e))
+
+    @staticmethod
+    def append_to_log(logger):
+        """ Makes ``logger`` append to its file, without writing a header. """
+        with _CMAESInternals._guard('resume a log'):
+            logger._have_logged     # Check it still exists
+            logger._have_logged = True
+
+    @staticmethod
+    def set_covariance(opt, covariance):
+        """ Sets the covariance matrix of the initial CMA-ES population. """
+        with _CMAESInternals._guard('set an initial covariance'):
+            opt._initialise()
+            opt._es.sm.C = covariance / opt._sigma0**2
+            opt._es.sm._decompose_C()
+
+    @staticmethod
+    def step_size(opt):
+        """ Returns the CMA-ES step size, relative to the initial step size.
+        """
+        with _CMAESInternals._guard('get the CMA-ES step size'):
+            return opt._es.sigma / opt._sigma0
+
+
+def _optimise(error, x0, boundaries, transformation, log_path,
+              pool=None, max_iterations=None,
+              max_unchanged_iterations=200, threshold=1e-11,
+              checkpoint=None, checkpoint_path=None, resume=False,
+              covariance=None, stop=None):
+    """
+    Runs a single CMA-ES optimisation, and returns a tuple ``(x, f, time,
+    iterations, evaluations)``.
+
+    If ``error`` is a :class:`pints.LogPDF` it is maximised instead, and the
+    returned ``f`` is the log pdf (including the transformation's Jacobian),
+    as in :class:`pints.OptimisationController`.
+
+    Sequential optimisations that use none of the options below are run with
+    a :class:`pints.OptimisationController`. Otherwise, an ask-and-tell loop
+    that follows the controller is used. In this loop, if ``error`` has an
+    ``evaluate_batch`` method, each population is evaluated with a single
+    call to this method (using a :class:`BatchEvaluator`) instead of
+    evaluating each point separately, unless it is an error that only
+    simulates one point at a time and a pool is given. Otherwise, points are
+    evaluated using the given :class:`WorkerPool`, or sequentially if no pool
+    is given.
+
+    If ``checkpoint`` is set, the optimiser state is stored at
+    ``checkpoint_path`` every ``checkpoint`` iterations. If ``resume`` is
+    ``True``, the optimisation continues from this checkpoint, and ``x0`` is
+    ignored.
+
+    If a ``covariance`` matrix (in the search space) is given, the initial
+    CMA-ES population is sampled from a distribution with this covariance,
+    centered on ``x0``.
+
+    If a function ``stop(iteration, f_best)`` is given, it is called every
+    time the progress is logged, and the optimisation ends if it returns
+    ``True``.
+
+    If ``error`` is a :class:`MultiResolutionError`, the optimisation starts
+    on the coarse error and switches to the full error once the step size
+    drops below the error's threshold. From then on the best position is
+    tracked separately, as the coarse and full errors are not comparable.
+
+    If a :class:`Profiler` is active, the time spent in each step of the
+    optimisation loop is added to it, along with the number of evaluations,
+    the number of non-finite errors, and the number of points rejected by
+    the boundaries.
+    """
+    multires = isinstance(error, MultiResolutionError)
+    if _has_batch(error):
+        pool = None
+
+    # Use an optimisation controller if no extra features are needed
+    if not (pool is not None or hasattr(error, 'evaluate_batch') or checkpoint
+            or resume or covariance is not None or stop is not None
+            or multires):
+        controller = pints.OptimisationController(
+            error, x0, boundaries=boundaries, transformation=transformation,
+            method=pints.CMAES)
+        controller.set_log_to_file(log_path, csv=True)
+        controller.set_max_iterations(max_iterations)
+        set_tolerance = getattr(    # Renamed in newer PINTS versions
+            controller, 'set_function_tolerance',
+            controller.set_max_unchanged_iterations)
+        set_tolerance(max_unchanged_iterations, threshold)
+        controller.set_parallel(False)
+        x, f = controller.run()
+        if _profiler is not None:
+            _profiler.count('evaluations', controller.evaluations())
+        return (x, f, controller.time(), controller.iterations(),
+                controller.evaluations())
+
+    # Apply transformation, and minimise -log(pdf) for log pdfs
+    minimising = not isinstance(error, pints.LogPDF)
+    if minimising:
+        function = error
+        if transformation is not None:
+            function = transformation.convert_error_measure(error)
+    else:
+        function = error
+        if transformation is not None:
+            function = transformation.convert_log_pdf(error)
+        function = pints.ProbabilityBasedError(function)
+    if transformation is not None:
+        boundaries = transformation.convert_boundaries(boundaries)
+
+    # Create optimiser, or restore from checkpoint
+    if resume:
+        with open(checkpoint_path, 'rb') as f:
+            state = pickle.load(f)
+        opt = state['optimiser']
+        np.random.set_state(state['random_state'])
+        iteration = state['iteration']
+        evaluations = state['evaluations']
+        unchanged_iterations = state['unchanged_iterations']
+        f_sig = state['f_sig']
+        time_offset = state['time']
+        best = state.get('best')
+
+        # Remove anything logged after the checkpoint was made
+        with open(log_path, 'r+') as f:
+            f.truncate(state['log_size'])
+    else:
+        if transformation is not None:
+            x0 = transformation.to_search(x0)
+
+        # With an initial covariance, choose the initial step size so that
+        # the scaled covariance matrix has an average variance of 1
+        sigma0 = None
+        if covariance is not None:
+            covariance = np.array(covariance, dtype=float)
+            sigma0 = np.sqrt(np.trace(covariance) / len(x0))
+        opt = pints.CMAES(x0, sigma0, boundaries=boundaries)
+        iteration = evaluations = unchanged_iterations = 0
+        f_sig = np.inf
+        time_offset = 0
+        best = None
+
+    # Start multi-resolution errors on the coarse error, unless resuming a run
+    # that had already switched to the full error. Once switched, ``best``
+    # holds the best full-resolution ``(x, f)``.
+    def set_coarse(coarse):
+        error.set_coarse(coarse)
+        if pool is not None:
+            pool.set_coarse(coarse)
+
+    if multires:
+        set_coarse(best is None)
+
+    # Create evaluator. Batch evaluation and pools work in the model space, so
+    # log pdfs are converted to errors by the evaluator.
+    n_workers = None
+    log_pdf = None if minimising else error
+    if pool is not None:
+        evaluator = BatchEvaluator(pool, transformation, log_pdf)
+        n_workers = min(pool.n_workers(), opt.suggested_population_size())
+    elif hasattr(error, 'evaluate_batch'):
+        evaluator = BatchEvaluator(error, transformation, log_pdf)
+    else:
+        evaluator = pints.SequentialEvaluator(function)
+    if not resume:
+        opt.set_population_size(opt.suggested_population_size(n_workers))
+
+        # Set initial covariance
+        if covariance is not None:
+            _CMAESInternals.set_covariance(opt, covariance)
+
+    # Show the same information as the controller
+    print('Minimising error measure' if minimising else 'Maximising LogPDF')
+    print('Using ' + str(opt.name()))
+    if pool is not None:
+        print('Running in parallel with ' + str(n_workers)
+              + ' worker processes.')
+    elif isinstance(evaluator, BatchEvaluator):
+        print('Running with batch evaluation.')
+    else:
+        print('Running in sequential mode.')
+    print('Population size: ' + str(opt.population_size()))
+
+    # Set up logging to screen and file, using the same fields as the
+    # controller
+    logger = pints.Logger()
+    logger.set_filename(log_path, csv=True)
+    logger.add_counter('Iter.', max_value=10000)
+    logger.add_counter('Eval.', max_value=10000 * opt.population_size())
+    logger.add_float('Best')
+    logger.add_float('Current')
+    logger.add_time('Time')
+    if resume:
+        _CMAESInternals.append_to_log(logger)
+    sign = 1 if minimising else -1
+
+    # Run
+    profiler = _profiler
+    timer = pints.Timer()
+    running = True
+    while running:
+        t0 = timer.time()
+        xs = opt.ask()
+        t1 = timer.time()
+        fs = evaluator.evaluate(xs)
+        t2 = timer.time()
+        opt.tell(fs)
+        evaluations += len(fs)
+
+        # Update profile
+        if profiler is not None:
+            t3 = timer.time()
+            profiler.add_time('optimiser.ask', t1 - t0)
+            profiler.add_time('optimiser.evaluate', t2 - t1)
+            profiler.add_time('optimiser.tell', t3 - t2)
+            profiler.count('evaluations', len(fs))
+            profiler.count(
+                'evaluations.non_finite', len(fs) - np.count_nonzero(
+                    np.isfinite(fs)))
+            profiler.count(
+                'boundaries.rejected', opt.population_size() - len(xs))
+
+        # Get best score, and switch resolution if needed
+        fb = opt.f_best()
+        if multires:
+            if best is None:
+                if _CMAESInternals.step_size(opt) < error.switch():
+                    set_coarse(False)
+                    best = (opt.x_best(), function(opt.x_best()))
+                    evaluations += 1
+                    f_sig = np.inf
+            elif len(fs):
+                i = np.argmin(fs)
+                if fs[i] < best[1]:
+                    best = (np.array(xs[i], copy=True), fs[i])
+            if best is not None:
+                fb = best[1]
+
+        # Check for significant changes in f
+        if np.abs(fb - f_sig) >= threshold:
+            unchanged_iterations = 0
+            f_sig = fb
+        else:
+            unchanged_iterations += 1
+
+        # Log, at the same intervals as the OptimisationController
+        logged = iteration < 3 or iteration % 20 == 0
+        if logged:
+            t0 = timer.time()
+            logger.log(
+                iteration, evaluations, sign * fb, sign * opt.f_guessed())
+            logger.log(time_offset + timer.time())
+            if profiler is not None:
+                profiler.add_time('optimiser.log', timer.time() - t0)
+        iteration += 1
+
+        # Store checkpoint
+        if checkpoint and iteration % checkpoint == 0:
+            t0 = timer.time()
+            state = {
+                'optimiser': opt,
+                'random_state': np.random.get_state(),
+                'iteration': iteration,
+                'evaluations': evaluations,
+                'unchanged_iterations': unchanged_iterations,
+                'f_sig': f_sig,
+                'time': time_offset + timer.time(),
+                'log_size': os.path.getsize(log_path),
+                'best': best,
+            }
+            with open(checkpoint_path + '.tmp', 'wb') as f:
+                pickle.dump(state, f)
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+            if profiler is not None:
+                profiler.add_time('optimiser.checkpoint', timer.time() - t0)
+
+        # Check stopping criteria
+        if max_iterations is not None and iteration >= max_iterations:
+            running = False
+        elif unchanged_iterations >= max_unchanged_iterations:
+            running = False
+        elif opt.stop():
+            running = False
+        elif logged and stop is not None and stop(iteration - 1, fb):
+            running = False
+
+    # Get best position and score, evaluating on the full error if the
+    # optimisation ended before switching resolution
+    x, fb = opt.x_best(), opt.f_best()
+    if multires:
+        if best is None:
+            set_coarse(False)
+            best = (x, function(x))
+            evaluations += 1
+        x, fb = best
+
+    # Log final iteration
+    time = time_offset + timer.time()
+    if not logged:
+        logger.log(iteration, evaluations, sign * fb, sign * opt.f_guessed())
+        logger.log(time)
+
+    # Get best parameters, in model space
+    if transformation is not None:
+        x = transformation.to_model(x)
+
+    return x, sign * fb, time, iteration, evaluations
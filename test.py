@@ -2,10 +2,14 @@
 #
 # Tests all notebooks
 #
+import contextlib
+import glob
+import io
 import os
 import re
 import subprocess
 import sys
+import traceback
 
 import nbconvert
 
@@ -110,6 +114,168 @@ def test_notebook(root, path):
     return None
 
 
+def test_fitting():
+    """
+    Runs short fits with the ion current library's ``fit()`` method, using
+    batch evaluation, a worker pool, sequential evaluation of a log-likelihood,
+    and checkpointing and resuming.
+    """
+    import tempfile
+
+    import numpy as np
+    import pints
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'ion-currents')
+    sys.path.insert(0, root)
+    import library
+
+    # Create synthetic data
+    np.random.seed(1)
+    protocol = library.load_protocol(
+        os.path.join(root, 'resources', 'pr3-steady-activation.mmt'))
+    times = np.arange(0, protocol.characteristic_time(), 1)
+    model = library.ModelHHSolver(protocol)
+    x = [2.26e-4, 0.0699, 3.45e-5, 0.05462, 0.0873, 8.92e-3, 5.15e-3, 0.03158,
+         0.1524]
+    values = model.simulate(x, times)
+    values += np.random.normal(0, 0.01, times.shape)
+    problem = pints.SingleOutputProblem(model, times, values)
+
+    class InterruptedError(library.MeanSquaredError):
+        """ An error that fails after a few evaluations. """
+        calls = 0
+
+        def evaluate_batch(self, parameters):
+            InterruptedError.calls += 1
+            if InterruptedError.calls > 5:
+                raise RuntimeError('Interrupted')
+            return super().evaluate_batch(parameters)
+
+    def directory(d, name):
+        """ Creates and returns a directory to store results in. """
+        path = os.path.join(d, name)
+        os.mkdir(path)
+        return path
+
+    def check(path, n):
+        """ Checks that ``path`` contains ``n`` finite results. """
+        parameters, info = library.load(os.path.join(path, 'result.txt'))
+        assert len(parameters) == n, path
+        assert np.all(np.isfinite(info)), path
+        return parameters, info
+
+    print('Testing fit() ' + '.' * 57, end='')
+    sys.stdout.flush()
+    try:
+        with tempfile.TemporaryDirectory() as d, \
+                contextlib.redirect_stdout(io.StringIO()):
+            boundaries = library.Boundaries()
+            transformation = library.transformation()
+            settings = dict(max_iterations=10, transformation=transformation)
+
+            # Batch evaluation
+            error = library.MeanSquaredError(problem)
+            library.fit(directory(d, 'batch'), error, boundaries,
+                        repeats=2, **settings)
+            check(os.path.join(d, 'batch'), 2)
+
+            # Worker pool
+            error = pints.MeanSquaredError(problem)
+            library.fit(directory(d, 'pool'), error, boundaries,
+                        parallel=2, **settings)
+            check(os.path.join(d, 'pool'), 1)
+
+            # Log-likelihood, maximised with an optimisation controller
+            log_likelihood = pints.GaussianKnownSigmaLogLikelihood(
+                problem, 0.01)
+            library.fit(directory(d, 'loglik'), log_likelihood, boundaries,
+                        parallel=False, **settings)
+            parameters, info = check(os.path.join(d, 'loglik'), 1)
+            assert abs(log_likelihood(parameters[0]) - info[0, 1]) < 1e-6 * (
+                abs(info[0, 1]))
+
+            # Runs interrupted before their first checkpoint are deleted
+            path = directory(d, 'resume')
+            try:
+                library.fit(path, InterruptedError(problem), boundaries,
+                            checkpoint=20, **settings)
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError('Expecting an interrupted fit.')
+            assert not glob.glob(os.path.join(path, 'result-*')), path
+
+            # Checkpointing and resuming
+            InterruptedError.calls = 0
+            try:
+                library.fit(path, InterruptedError(problem), boundaries,
+                            checkpoint=2, **settings)
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError('Expecting an interrupted fit.')
+            check(path, 0)
+            library.fit(path, library.MeanSquaredError(problem), boundaries,
+                        resume=True, **settings)
+            check(path, 1)
+            assert not glob.glob(os.path.join(path, '*.pickle'))
+
+    except Exception:
+        print('FAIL')
+        traceback.print_exc()
+        return False
+    print('ok')
+    return True
+
+
+def test_models():
+    """
+    Creates each of the ion current library's forward models, and checks that
+    they agree on a short simulation.
+    """
+    import numpy as np
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'ion-currents')
+    sys.path.insert(0, root)
+    import library
+
+    print('Testing models ' + '.' * 56, end='')
+    sys.stdout.flush()
+    try:
+        protocol = library.load_protocol(
+            os.path.join(root, 'resources', 'pr3-steady-activation.mmt'))
+        times = np.arange(0, protocol.characteristic_time(), 1)
+        x = [2.26e-4, 0.0699, 3.45e-5, 0.05462, 0.0873, 8.92e-3, 5.15e-3,
+             0.03158, 0.1524]
+        reference = library.ModelHHSolver(protocol).simulate(x, times)
+        scale = np.max(np.abs(reference))
+
+        # CVODE, with switchable tolerances and failure counting
+        model = library.ModelCVODESolver(
+            protocol, tolerance=(1e-8, 1e-8), loose_tolerance=(1e-4, 1e-4))
+        assert np.max(np.abs(model.simulate(x, times) - reference)) < (
+            1e-4 * scale)
+        model.set_loose(True)
+        assert model.loose()
+        model.simulate(x, times)
+        assert model.n_simulations() == 2
+        assert model.n_failures() == 0
+
+        # Markov model, using eigendecomposition
+        model = library.ModelMarkovSolver(protocol)
+        assert np.max(np.abs(model.simulate(x, times) - reference)) < (
+            1e-4 * scale)
+
+    except Exception:
+        print('FAIL')
+        traceback.print_exc()
+        return False
+    print('ok')
+    return True
+
+
 def natural_sort_key(s):
     """
     Function to use as ``key`` in a sort, to get natural sorting of strings
@@ -133,5 +299,7 @@ if __name__ == '__main__':
     print()
     print('  Press Ctrl+C to abort.')
     print()
-    if not test_notebooks():
+    ok = test_models()
+    ok = test_fitting() and ok
+    if not test_notebooks() or not ok:
         sys.exit(1)